@@ -1,30 +1,97 @@
 import csv
 from io import StringIO
+from itertools import islice
+from tempfile import SpooledTemporaryFile
 import json
 
+# CSVs larger than this many bytes are spooled to disk instead of being held in memory
+CSV_SPOOL_MAX_SIZE = 1500000
+# Number of rows encoded at a time when writing the CSV
+CSV_CHUNK_ROWS = 1000
+
 
 def csv_and_mapping_create(contacts, fields):
     """Helper function that takes a dictionary of contacts and CallHub field name -> id mappings and creates
-    a CSV in-memory that CallHub will accept.
+    a CSV that CallHub will accept. Small CSVs are kept in memory, large ones are spooled to a temporary file.
+    CallHub.bulk_create uses csv_create and mapping_create directly, this is kept as public API for existing callers.
     Returns:
-        csv_file (``file``): CSV file for upload to CallHub
-        mapping (``dict``): A mapping of CallHub field IDs to CSV column indexes
+        csv_file (``file``): Binary CSV file for upload to CallHub, rewound to the start. The caller should close it.
+        mapping (``str``): JSON mapping of CallHub field IDs to CSV column indexes
         >>> {"0": "0", "1": "1"}
         """
-    csv_file = StringIO()
+    # Columns are indexed by field id, which isn't necessarily smaller than the number of fields
+    columns = [None] * (max(fields.values(), default=-1) + 2)
+    for field, field_id in fields.items():
+        columns[field_id] = field
+    return csv_create(contacts, columns), mapping_create(columns, fields)
+
+
+def csv_create(contacts, columns):
+    """Helper function that writes contacts to a CSV with the given columns. Doesn't need to know the CallHub account's
+    fields, so it can run while they're being fetched.
+    Args:
+        contacts (``list``): Contacts, where each contact is a dict of field names to values
+        columns (``list``): Field name of each column. Columns that are None are left empty.
+    Returns:
+        csv_file (``file``): Binary CSV file for upload to CallHub, rewound to the start. The caller should close it.
+    """
+    csv_file = SpooledTemporaryFile(max_size=CSV_SPOOL_MAX_SIZE, mode="w+b")
+
+    # Create CSV (stored in memory until it grows past CSV_SPOOL_MAX_SIZE)
+    # Rows are written in chunks to a small text buffer, then encoded into the file so it can be streamed as bytes
+    rows_iter = _rows(contacts, columns)
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    while True:
+        writer.writerows(islice(rows_iter, CSV_CHUNK_ROWS))
+        if not buffer.tell():
+            break
+        csv_file.write(buffer.getvalue().encode("utf-8"))
+        buffer.seek(0)
+        buffer.truncate()
+    csv_file.seek(0)
+    return csv_file
+
+
+class SizedFile:
+    """Wraps a file so requests-toolbelt's MultipartEncoder can tell how much of it is left to read. Without a len, the
+    encoder sizes files with fileno(), which makes a SpooledTemporaryFile roll over to disk however small it is.
+    Args:
+        file (``file``): Binary file to read from its current position
+    """
+    def __init__(self, file):
+        self.file = file
+        position = file.tell()
+        file.seek(0, 2)
+        self.size = file.tell()
+        file.seek(position)
 
-    # Create CSV (stored in memory as StringIO)
+    @property
+    def len(self):
+        return self.size - self.file.tell()
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+
+def _rows(contacts, columns):
+    """ Generates the CSV row of each contact """
+    column_items = [(column, field) for column, field in enumerate(columns) if field is not None]
+    # Every field's column is overwritten for each contact, so a single row can be reused
+    row = [""] * len(columns)
     for contact in contacts:
-        new_row = [""] * (len(fields) + 1)
-        for field in fields:
-            if contact.get(field):
-                new_row[fields[field]] = contact[field]
-        csv.writer(csv_file).writerow(new_row)
-
-    # Create mapping for CallHub upload
-    mapping = {}
-    for field in fields:
-        mapping[fields[field]] = str(fields[field])
-    mapping = json.dumps(mapping).replace("'", "\"")
-
-    return csv_file.getvalue(), mapping
+        for column, field in column_items:
+            row[column] = contact.get(field) or ""
+        yield row
+
+
+def mapping_create(columns, fields):
+    """Helper function that maps CallHub field ids to the columns of a CSV made by csv_create
+    Args:
+        columns (``list``): Field name of each column, as given to csv_create
+        fields (``dict``): CallHub field name -> id mappings
+    Returns:
+        mapping (``str``): JSON mapping of CallHub field IDs to CSV column indexes
+        >>> {"0": "0", "1": "1"}
+    """
+    return json.dumps({fields[field]: str(column) for column, field in enumerate(columns) if field is not None})
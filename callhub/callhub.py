@@ -1,23 +1,98 @@
 import requests
 from .auth import CallHubAuth
-from ratelimit import limits, sleep_and_retry
-from .bulk_upload_tools import csv_and_mapping_create
-from requests.structures import CaseInsensitiveDict
-import types
+from .bulk_upload_tools import SizedFile, csv_create, mapping_create
+from .token_bucket import TokenBucket, backoff_delay, retry_delay
+import functools
+import re
 import math
 from requests_futures.sessions import FuturesSession
-from collections import defaultdict
-from concurrent.futures import ProcessPoolExecutor
-import traceback
+from requests_toolbelt.multipart.encoder import MultipartEncoder
+from urllib3.util.request import ACCEPT_ENCODING
+from collections import defaultdict, deque
+from concurrent.futures import wait, FIRST_COMPLETED
+from itertools import islice
 import time
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json(response):
+    """
+    Decodes the JSON body of a response, using orjson when it's installed since it's noticeably faster on large pages
+    Args:
+        response (``requests.Response``): Response to decode
+    Returns:
+        body (``dict``): Decoded JSON body
+    """
+    if orjson is None:
+        return response.json()
+    return orjson.loads(response.content)
+
+
+# Matches the id at the end of a CallHub resource url, eg: "https://api.callhub.io/v1/dnc_lists/1234/"
+_ID_FROM_URL = re.compile(r"([^/]+)/?$")
+
+
+def _id_from_url(url):
+    """ Returns the id of a CallHub resource from its url """
+    return _ID_FROM_URL.search(url).group(1)
+
+
+def _rate_limited(category):
+    """
+    Decorator for CallHub methods that must wait for a token from the instance's rate limiter for the given category
+    (eg: "BULK_CREATE") before running. Limiter state lives on each instance, so instances don't share limits and
+    nothing has to be rebuilt when a CallHub is created.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            self._acquire_token(category)
+            return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _RateLimitedSession(FuturesSession):
+    """
+    FuturesSession that sends requests through its CallHub's rate limiter. Requests are sent from the session's worker
+    threads, so submitting a request never blocks the caller; the workers wait for tokens instead.
+    """
+    def __init__(self, callhub, **kwargs):
+        super().__init__(**kwargs)
+        self.callhub = callhub
+
+    def send(self, request, **kwargs):
+        return self.callhub._rate_limited_send(self, request, **kwargs)
+
 
 class CallHub:
     API_LIMIT = {
         "GENERAL": {"calls": 13, "period": 1},
         "BULK_CREATE": {"calls": 1, "period": 70},
     }
-
-    def __init__(self, api_domain, api_key=None, rate_limit=API_LIMIT):
+    # Seconds that DNC lists fetched from CallHub are reused before being fetched again
+    DNC_LISTS_CACHE_TTL = 300
+    # remove_dnc looks up numbers missing from its cache directly, unless there are more of them than this fraction of
+    # the cache's size, in which case the whole cache is refreshed
+    DNC_LOOKUP_RATIO = 0.1
+    # Number of pages requested ahead of the one being read when fetching paged data
+    PAGES_IN_FLIGHT = 50
+    # Seconds that fields fetched from CallHub are reused before being fetched again
+    FIELDS_CACHE_TTL = 300
+    # Number of times a request is retried after CallHub responds 429 Too Many Requests or 503 Service Unavailable
+    MAX_THROTTLED_RETRIES = 10
+    # Status codes that mean a request can be sent again once CallHub has had time to recover
+    RETRY_STATUSES = frozenset((429, 503))
+    # Number of times _handle_requests retries requests that failed with any other 5xx status, when asked to retry
+    REQUEST_RETRIES = 3
+    # Longest delay in seconds waited before a retry, or that rate limit headers can pause requests for, whatever
+    # Retry-After or RateLimit-Reset ask for
+    MAX_RETRY_DELAY = 60
+
+    def __init__(self, api_domain, api_key=None, rate_limit=API_LIMIT, prefetch_fields=False):
         """
         Instantiates a new CallHub instance
         >>> callhub = CallHub("https://api-na1.callhub.io")
@@ -37,13 +112,27 @@ class CallHub:
                   practice a delay of 60s exactly can trip their rate limiter anyways)
                 - Default limits all other API requests to 13 per second (CallHub support states their limit is 20/s but
                   this plays it on the safe side, because other rate limiters seem a little sensitive)
+            prefetch_fields (``bool``, optional): Start fetching the account's fields in the background on creation,
+                so the first bulk_create or create_contact doesn't have to wait for them. Disabled by default.
         """
-        self.session = FuturesSession(max_workers=43)
-
-        # Attempt 3 retries for failed connections
-        adapter = requests.adapters.HTTPAdapter(max_retries=3)
+        if rate_limit:
+            # Size the worker pool to the general rate limit: requests beyond that would only be waiting for a token
+            self._rate_limiters = {category: TokenBucket(**limit) for category, limit in rate_limit.items()}
+            max_workers = rate_limit["GENERAL"]["calls"]
+        else:
+            self._rate_limiters = {}
+            max_workers = 43
+        # The general rate limit applies to every request sent by self.session (see _RateLimitedSession)
+        self.session = _RateLimitedSession(self, max_workers=max_workers)
+
+        # Attempt 3 retries for failed connections. Keep a connection per worker open so connections are reused
+        # instead of being discarded once urllib3's default pool of 10 is full.
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(max_workers, requests.adapters.DEFAULT_POOLSIZE),
+                                                max_retries=3)
         self.session.mount('https://', adapter)
         self.session.mount('http://', adapter)
+        # Ask for every compression urllib3 can decode, which includes brotli when it's installed
+        self.session.headers["Accept-Encoding"] = ACCEPT_ENCODING
 
         # Truncate final '/' off of API domain if it was provided
         if api_domain[-1] == "/":
@@ -51,97 +140,205 @@ class CallHub:
         else:
             self.api_domain = api_domain
 
-        if rate_limit:
-            # Apply general rate limit to self.session.get
-            rate_limited_get = sleep_and_retry(limits(**rate_limit["GENERAL"])(FuturesSession.get))
-            self.session.get = types.MethodType(rate_limited_get, self.session)
-            
-            # Apply general rate limit to self.session.post
-            rate_limited_post = sleep_and_retry(limits(**rate_limit["GENERAL"])(FuturesSession.post))
-            self.session.post = types.MethodType(rate_limited_post, self.session)
-            
-            # Apply bulk rate limit to self.bulk_create
-            self.bulk_create = sleep_and_retry(limits(**rate_limit["BULK_CREATE"])(self.bulk_create))
+        # Urls of the endpoints used by this wrapper, built once rather than on every call
+        self._endpoints = {name: "{}/v1/{}/".format(self.api_domain, path) for name, path in {
+            "agents": "agents",
+            "agent_leaderboard": "analytics/agent-leaderboard",
+            "contacts": "contacts",
+            "fields": "contacts/fields",
+            "bulk_create": "contacts/bulk_create",
+            "dnc_contacts": "dnc_contacts",
+            "dnc_lists": "dnc_lists",
+            "campaigns": "callcenter_campaigns",
+            "power_campaigns": "power_campaign",
+            "phonebooks": "phonebooks",
+            "webhooks": "webhooks",
+        }.items()}
 
         self.session.auth = CallHubAuth(api_key=api_key)
 
-        # validate_api_key returns administrator email on success
-        self.admin_email = self.validate_api_key()
-
         # cache for do-not-contact number/list to id mapping
         self.dnc_cache = {}
 
+        # cache for field name to id mapping, and the time it was fetched
+        self._fields_cache = None
+        self._fields_cache_lowercase = frozenset()
+        self._fields_cache_time = 0
+
+        # cache for dnc list id to name mapping, and the time it was fetched
+        self._dnc_lists_cache = None
+        self._dnc_lists_cache_time = 0
+
+        # page size and number of pages each paged endpoint had when it was last fetched
+        self._page_hints = {}
+
+        # pending request for fields and the time it was sent, sent on creation when prefetch_fields is set and used by
+        # the next call to fields()
+        self._fields_future = None
+        self._fields_future_time = 0
+        if prefetch_fields:
+            self._request_fields()
+
+        # administrator email, fetched by validate_api_key the first time it's needed
+        self._admin_email = None
+
+    @property
+    def admin_email(self):
+        """
+        Email of the administrator account. The api key is validated the first time this is accessed, so it may raise
+        the same errors as validate_api_key.
+        """
+        if self._admin_email is None:
+            self.validate_api_key()
+        return self._admin_email
+
     def __repr__(self):
         return "<CallHub admin: {}>".format(self.admin_email)
 
+    def _acquire_token(self, category):
+        """
+        Internal function. Blocks until the rate limiter for the given category (eg: "GENERAL") allows another
+        request. Does nothing if rate limiting is disabled.
+        """
+        rate_limiter = self._rate_limiters.get(category)
+        if rate_limiter:
+            rate_limiter.acquire()
+
+    def _rate_limited_send(self, session, request, **kwargs):
+        """
+        Internal function that sends every request for self.session, on its worker threads. Waits for the general
+        rate limiter before sending a request, keeps the rate limiter in sync with CallHub's rate limit headers, and
+        retries requests that CallHub throttled (429) or couldn't serve (503) after the delay CallHub asks for, backing
+        off exponentially if it doesn't say.
+        """
+        rate_limiter = self._rate_limiters.get("GENERAL")
+        for attempt in range(self.MAX_THROTTLED_RETRIES + 1):
+            self._acquire_token("GENERAL")
+            response = requests.Session.send(session, request, **kwargs)
+            if rate_limiter:
+                rate_limiter.sync_from_headers(response.headers, max_pause=self.MAX_RETRY_DELAY)
+            # Streamed bodies (eg: bulk_create uploads) have already been consumed and can't be sent again
+            replayable = request.body is None or isinstance(request.body, (bytes, str))
+            if response.status_code not in self.RETRY_STATUSES or attempt == self.MAX_THROTTLED_RETRIES \
+                    or not replayable:
+                return response
+
+            delay = min(retry_delay(response.headers.get("Retry-After"), default=backoff_delay(attempt)),
+                        self.MAX_RETRY_DELAY)
+            response.close()
+            if rate_limiter:
+                # Hold back every request on this session, not just this one
+                rate_limiter.pause(delay)
+            else:
+                time.sleep(delay)
+
     def _collect_fields(self, contacts):
-        """ Internal Function to get all fields used in a list of contacts """
-        fields = set()
-        for contact in contacts:
-            for key in contact:
-                fields.add(key)
-        return fields
+        """ Internal Function to get all fields used in a list of contacts, lowercased """
+        # Keys are deduplicated by set.union in C first, so each distinct field is only lowercased once
+        return {field.lower() for field in set().union(*contacts)}
 
-    def _assert_fields_exist(self, contacts):
+    def _assert_fields_exist(self, contacts, fields_in_callhub=None):
         """
         Internal function to check if fields in a list of contacts exist in CallHub account
         If fields do not exist, raises LookupError.
+        Keyword Args:
+            fields_in_callhub (``dict``, optional): Fields in the CallHub account, as returned by fields(). Fetched
+                if not provided.
+        Returns:
+            fields (``dict``): Fields in the CallHub account, so callers don't need to get them again
         """
         # Note: CallHub fields are implemented funkily. They can contain capitalization but "CUSTOM_FIELD"
         # and "custom_field" cannot exist together in the same account. For that reason, for the purposes of API work,
         # fields are treated as case insensitive despite capitalization being allowed. Attempting to upload a contact
         # with "CUSTOM_FIELD" will match to "custom_field" in a CallHub account.
-        fields_in_contacts = self._collect_fields(contacts)
-        fields_in_callhub = self.fields()
-
-        # Ensure case insensitivity and convert to set
-        fields_in_contact = set([field.lower() for field in fields_in_contacts])
-        fields_in_callhub = set([field.lower() for field in fields_in_callhub.keys()])
-
-        if fields_in_contact.issubset(fields_in_callhub):
-            return True
+        fields_in_contact = self._collect_fields(contacts)
+        if fields_in_callhub is None:
+            fields_in_callhub = self.fields()
+        # The lowercased account fields are kept alongside the fields cache, so they usually don't need rebuilding
+        if fields_in_callhub is self._fields_cache:
+            fields_in_account = self._fields_cache_lowercase
         else:
+            fields_in_account = frozenset(field.lower() for field in fields_in_callhub)
+
+        missing_fields = fields_in_contact - fields_in_account
+        if missing_fields:
             raise LookupError("Attempted to upload contact (s) that contain fields that haven't been "
-                              "created in CallHub. Fields present in upload: {} Fields present in "
-                              "account: {}".format(fields_in_contact, fields_in_callhub))
+                              "created in CallHub. Fields missing from account: {} Fields present in "
+                              "account: {}".format(sorted(missing_fields), sorted(fields_in_account)))
+        return fields_in_callhub
 
     def validate_api_key(self):
         """
         Returns admin email address if API key is valid. In rare cases, may be unable to find admin email address, and
         returns a warning in that case. If API key invalid, raises ValueError. If the CallHub API returns unexpected
-        information, raises RunTimeError.
+        information, raises RunTimeError. The api key isn't validated when CallHub is created, call this to check it
+        up front.
         Returns:
             username (``str``): Email of administrator account
         """
-        response = self.session.get("{}/v1/agents/".format(self.api_domain)).result()
-        if response.json().get("detail") in ['User inactive or deleted.', 'Invalid token.']:
+        response = self.session.get(self._endpoints["agents"]).result()
+        agents = _json(response)
+        if agents.get("detail") in {'User inactive or deleted.', 'Invalid token.'}:
             raise ValueError("Bad API Key")
-        elif "count" in response.json():
-            if response.json()["count"]:
-                return response.json()["results"][0]["owner"][0]["username"]
-            else:
-                return "Cannot deduce admin account. No agent accounts (not even the default account) exist."
-        else:
+        count = agents.get("count")
+        if count is None:
             raise RuntimeError("CallHub API is not returning expected values, but your api_key is fine. Their API "
                                "specifies that https://callhub-api-domain/v1/agents returns a 'count' field, but this was "
                                "not returned. Please file an issue on GitHub for this project, if an issue for this not "
                                "already exist.")
+        if count:
+            self._admin_email = agents["results"][0]["owner"][0]["username"]
+        else:
+            self._admin_email = "Cannot deduce admin account. No agent accounts (not even the default account) exist."
+        return self._admin_email
 
     def agent_leaderboard(self, start, end):
         params = {"start_date": start, "end_date": end}
-        response = self.session.get("{}/v1/analytics/agent-leaderboard/".format(self.api_domain), params=params).result()
-        return response.json().get("plot_data")
+        response = self.session.get(self._endpoints["agent_leaderboard"], params=params).result()
+        return _json(response).get("plot_data")
+
+    def _fields_cache_is_fresh(self, now):
+        """ Internal function that checks if fields were fetched less than FIELDS_CACHE_TTL seconds ago """
+        return self._fields_cache is not None and now - self._fields_cache_time < self.FIELDS_CACHE_TTL
+
+    def _request_fields(self):
+        """
+        Internal function. Starts fetching fields in the background, unless they're cached or already being fetched, so
+        the next call to fields() has less or nothing to wait for.
+        """
+        now = time.monotonic()
+        if self._fields_future is None and not self._fields_cache_is_fresh(now):
+            self._fields_future = self.session.get(self._endpoints["fields"])
+            self._fields_future_time = now
 
-    def fields(self):
+    def fields(self, force=False):
         """
-        Returns a list of fields configured in the CallHub account and their ids
+        Returns a list of fields configured in the CallHub account and their ids. Fields are cached for
+        FIELDS_CACHE_TTL seconds, so repeated uploads don't fetch them again.
+        Keyword Args:
+            force (``bool``, optional): Fetch fields from CallHub even if they're cached, eg: after creating a field
+                in CallHub. Default is False.
         Returns:
             fields (``dict``): dictionary of fields and ids
             >>> {"first name": 0, "last name": 1}
         """
-        response = self.session.get('{}/v1/contacts/fields/'.format(self.api_domain)).result()
-        return {field['name']: field["id"] for field in response.json()["results"]}
-
+        now = time.monotonic()
+        if not force and self._fields_cache_is_fresh(now):
+            return self._fields_cache
+        fields_future, self._fields_future = self._fields_future, None
+        # The fields are as old as the request for them, not the time it was waited for
+        fetched_time = self._fields_future_time
+        # A pending request may have been sent before the fields changed, so force always sends a new one
+        if fields_future is None or force or now - fetched_time >= self.FIELDS_CACHE_TTL:
+            fields_future = self.session.get(self._endpoints["fields"])
+            fetched_time = now
+        response = fields_future.result()
+        self._fields_cache = {field['name']: field["id"] for field in _json(response)["results"]}
+        self._fields_cache_lowercase = frozenset(field.lower() for field in self._fields_cache)
+        self._fields_cache_time = fetched_time
+        return self._fields_cache
+
+    @_rate_limited("BULK_CREATE")
     def bulk_create(self, phonebook_id, contacts, country_iso):
         """
         Leverages CallHub's bulk-upload feature to create many contacts. Supports custom fields.
@@ -154,34 +351,40 @@ class CallHub:
             country_iso(``str``): ISO 3166 two-char country code,
                 see https://en.wikipedia.org/wiki/ISO_3166-1_alpha-2
         """
-        # Step 1. Get all fields from CallHub account
-        # Step 2. Check if all fields provided for contacts exist in CallHub account
-        # Step 3. Turn list of dictionaries into a CSV file and create a column mapping for the file
+        # Step 1. Start getting all fields from CallHub account
+        # Step 2. Turn list of dictionaries into a CSV file while the fields are on their way
+        # Step 3. Check if all fields provided for contacts exist in CallHub account and create a column mapping
         # Step 4. Upload the CSV and column mapping to CallHub
-
-        contacts = [CaseInsensitiveDict(contact) for contact in contacts]
-
-        if self._assert_fields_exist(contacts):
-            # Create CSV file in memory in a way that pleases CallHub and generate column mapping
-            csv_file, mapping = csv_and_mapping_create(contacts, self.fields())
-
-            # Upload CSV
-            data = {
-                'phonebook_id': phonebook_id,
+        self._request_fields()
+
+        # Fields are case insensitive (see _assert_fields_exist), so field names are lowercased once up front and the
+        # CSV is built with plain dict lookups
+        contacts = [{field.lower(): value for field, value in contact.items()} for contact in contacts]
+        columns = sorted(self._collect_fields(contacts))
+        csv_file = csv_create(contacts, columns)
+
+        with csv_file:
+            fields = self._assert_fields_exist(contacts)
+            fields = {field.lower(): field_id for field, field_id in fields.items()}
+            mapping = mapping_create(columns, fields)
+
+            # Upload CSV. The multipart body is streamed from the CSV file rather than being built in memory.
+            data = MultipartEncoder(fields={
+                'phonebook_id': str(phonebook_id),
                 'country_choice': 'custom',
                 'country_ISO': country_iso,
-                'mapping': mapping
-            }
-
-            response = self.session.post('{}/v1/contacts/bulk_create/'.format(self.api_domain), data=data,
-                                         files={'contacts_csv': csv_file}).result()
-            if "Import in progress" in response.json().get("message", ""):
-                return True
-            elif 'Request was throttled' in response.json().get("detail", ""):
-                raise RuntimeError("Bulk_create request was throttled because rate limit was exceeded.",
-                                   response.json())
-            else:
-                raise RuntimeError("CallHub did not report that import was successful: ", response.json())
+                'mapping': mapping,
+                'contacts_csv': ('contacts.csv', SizedFile(csv_file), 'text/csv')
+            })
+            response = self.session.post(self._endpoints["bulk_create"], data=data,
+                                         headers={'Content-Type': data.content_type}).result()
+        result = _json(response)
+        if "Import in progress" in result.get("message", ""):
+            return True
+        elif 'Request was throttled' in result.get("detail", ""):
+            raise RuntimeError("Bulk_create request was throttled because rate limit was exceeded.", result)
+        else:
+            raise RuntimeError("CallHub did not report that import was successful: ", result)
 
     def create_contact(self, contact):
         """
@@ -194,32 +397,45 @@ class CallHub:
         Returns:
             (``str``): ID of created contact or None if contact not created
         """
-        if self._assert_fields_exist([contact]):
-            url = "{}/v1/contacts/".format(self.api_domain)
-            responses, errors = self._handle_requests([{
-                "func": self.session.post,
-                "func_params": {"url": url, "data": {"name": contact}},
-                "expected_status": 201
-            }])
-            if errors:
-                raise RuntimeError(errors)
-            return responses[0].json().get("id")
+        self._assert_fields_exist([contact])
+        url = self._endpoints["contacts"]
+        responses, errors = self._handle_requests([{
+            "func": self.session.post,
+            "func_params": {"url": url, "data": {"name": contact}},
+            "expected_status": 201
+        }])
+        if errors:
+            raise RuntimeError(errors)
+        return _json(responses[0]).get("id")
 
-    def get_contacts(self, limit):
+    def get_contacts(self, limit=float(math.inf)):
         """
         Gets all contacts.
-        Args:
-            limit (``int``): Limit of number of contacts to get. If limit not provided, will
-                return first 100 contacts.
+        Keyword Args:
+            limit (``int``, optional): Limit of number of contacts to get. Default is no limit.
         Returns:
             contact_list (``list``): List of contacts, where each contact is a dict of key value pairs.
         """
-        contacts_url = "{}/v1/contacts/".format(self.api_domain)
-        return self._get_paged_data(contacts_url, limit)
+        return list(self.iter_contacts(limit))
+
+    def iter_contacts(self, limit=float(math.inf)):
+        """
+        Gets all contacts lazily. Pages are fetched ahead of time but only a few of them are held in memory at once,
+        so this is much lighter than get_contacts for accounts with many contacts.
+        >>> for contact in callhub.iter_contacts():
+        >>>     print(contact["contact"])
+        Keyword Args:
+            limit (``int``, optional): Limit of number of contacts to get. Default is no limit.
+        Returns:
+            contacts (``generator``): Contacts in the order CallHub returns them, where each contact is a dict of
+                key value pairs.
+        """
+        contacts_url = self._endpoints["contacts"]
+        return self._iter_paged_data(contacts_url, limit)
 
     def _get_paged_data(self, url, limit=float(math.inf)):
         """
-        Internal function. Leverages _bulk_requests to aggregate paged data and return it quickly.
+        Internal function. Aggregates paged data from _iter_paged_data and returns it.
         Args:
             url (``str``): API endpoint to get paged data from.
         Keyword Args:
@@ -228,103 +444,185 @@ class CallHub:
             paged_data (``list``) All of the paged data as a signle list of dicts, where each dict contains key value
                 pairs that represent each individual item in a page.
         """
-        first_page = self.session.get(url).result()
-        if first_page.status_code != 200:
+        return list(self._iter_paged_data(url, limit))
+
+    def _iter_paged_data(self, url, limit=float(math.inf)):
+        """
+        Internal function. Yields paged data item by item, in order. Up to PAGES_IN_FLIGHT pages are requested ahead
+        of the page currently being yielded.
+        Args:
+            url (``str``): API endpoint to get paged data from.
+        Keyword Args:
+            limit (``float or int``): Limit of paged data to get. Default is infinity.
+        Returns:
+            paged_data (``generator``): Each individual item in each page, as a dict of key value pairs.
+        """
+        # Request the pages we expect to need along with the first so they're already on their way once the page
+        # count is known. Without a hint from the last time this endpoint was fetched, only the second page is guessed.
+        page_size_hint, page_count_hint = self._page_hints.get(url, (None, 2))
+        if page_size_hint and limit != math.inf:
+            page_count_hint = min(page_count_hint, math.ceil(limit / page_size_hint))
+        first_page_future = self.session.get(url, params={"page": 1})
+        pending_pages = deque()
+        # Speculative requests for pages that turned out not to be needed
+        unneeded_pages = []
+        if limit > 0:
+            for page_number in range(2, min(page_count_hint, self.PAGES_IN_FLIGHT + 1) + 1):
+                pending_pages.append(self.session.get(url, params={"page": page_number}))
+
+        try:
+            first_page = self._page_result(first_page_future, url)
+
+            # Handle either limit of 0 or no results
+            if first_page["count"] == 0 or limit == 0:
+                return
+
+            # Set limit to the smallest of either the count or the limit
+            limit = min(first_page["count"], limit)
+
+            page_size = len(first_page["results"])
+            # Calculate number of pages (-(-a // b) is integer division rounded up)
+            num_pages = -(-limit // page_size)
+            self._page_hints[url] = (page_size, -(-first_page["count"] // page_size))
+
+            # Cancel speculative requests for pages past the last one needed
+            while len(pending_pages) > num_pages - 1:
+                unneeded_pages.append(pending_pages.pop())
+            next_page = len(pending_pages) + 2
+            remaining = limit
+
+            page = first_page
+            while True:
+                results = page["results"][:remaining]
+                remaining -= len(results)
+                yield from results
+
+                # Keep the window of requested pages full
+                while next_page <= num_pages and len(pending_pages) < self.PAGES_IN_FLIGHT:
+                    pending_pages.append(self.session.get(url, params={"page": next_page}))
+                    next_page += 1
+                if not pending_pages:
+                    break
+                page = self._page_result(pending_pages.popleft(), url)
+        finally:
+            # Don't send requests for pages that won't be used, eg: if the caller stopped iterating early. Requests that
+            # are already being sent can't be cancelled, so wait for them rather than leave them running after we return
+            unneeded_pages.extend(pending_pages)
+            for page_future in unneeded_pages:
+                page_future.cancel()
+            wait(unneeded_pages)
+
+    def _page_result(self, page_future, url):
+        """
+        Internal function. Waits for a page requested by _iter_paged_data and returns its decoded body. Raises
+        RuntimeError if the page could not be fetched.
+        """
+        page = page_future.result()
+        if page.status_code != 200:
             raise RuntimeError("Status code {} when making request to: "
-                                "{}, expected 200. Details: {})".format(first_page.status_code,
+                                "{}, expected 200. Details: {})".format(page.status_code,
                                                                         url,
-                                                                        first_page.text))
-        first_page = first_page.json()
-
-        # Handle either limit of 0 or no results
-        if first_page["count"] == 0 or limit == 0:
-            return []
-
-        # Set limit to the smallest of either the count or the limit
-        limit = min(first_page["count"], limit)
-
-        # Calculate number of pages
-        page_size = len(first_page["results"])
-        num_pages = math.ceil(limit/page_size)
-
-        requests = []
-        for i in range(1, num_pages+1):
-            requests.append({"func": self.session.get,
-                             "func_params": {"url": url, "params": {"page": i}},
-                             "expected_status": 200})
-        responses_list, errors = self._handle_requests(requests)
-        if errors:
-            raise RuntimeError(errors)
-
-        # Turn list of responses into aggregated data from all pages
-        paged_data = []
-        for response in responses_list:
-            paged_data += response.json()["results"]
-        paged_data = paged_data[:limit]
-        return paged_data
+                                                                        page.text))
+        return _json(page)
 
     def _handle_requests(self, requests_list, aggregate_json_value=None, retry=False, current_retry_count=0):
         """
-        Internal function. Executes a list of requests in batches, asynchronously. Allows fast execution of many reqs.
+        Internal function. Executes a list of requests asynchronously. Allows fast execution of many reqs.
         >>> requests_list = [{"func": session.get,
         >>>                   "func_params": {"url":"https://callhub-api-domain/v1/contacts/", "params":{"page":"1"}}}
         >>>                   "expected_status": 200]
         >>> _bulk_request(requests_list)
         Args:
-            requests_list (``list``): List of dicts that each include a request function, its parameters, and an
-                optional expected status. These will be executed in batches.
-        """
-        # Send bulk requests in batches of at most 500
-        batch_size = 500
-        requests_awaiting_response = []
-        responses = []
-        errors = []
-        for i, request in enumerate(requests_list):
-            # Execute request asynchronously
-            requests_awaiting_response.append(request["func"](**request["func_params"]))
-            # Every time we execute batch_size requests OR we have made our last request, wait for all requests
-            # to have received responses before continuing. This batching prevents us from having tens or hundreds of
-            # thousands of pending requests with CallHub
-            if i % batch_size == 0 or i == (len(requests_list)-1):
-                for req_awaiting_response in requests_awaiting_response:
-                    response = req_awaiting_response.result()
-                    try:
-                        if requests_list[i]["expected_status"] and response.status_code != int(requests_list[i]["expected_status"]):
-                            raise RuntimeError("Status code {} when making request to: "
-                                               "{}, expected {}. Details: {})".format(response.status_code,
-                                                                         requests_list[i]["func_params"]["url"],
-                                                                         requests_list[i]["expected_status"],
-                                                                         response.text))
-                        responses.append(response)
-
-                    except RuntimeError as api_except:
-                        errors.append((requests_list[i], api_except))
-
-                requests_awaiting_response = []
-
-        if errors and retry and current_retry_count < 1:
-            failed_requests = [error[0] for error in errors]
-            new_responses, errors = self._handle_requests(failed_requests, retry=True, current_retry_count=current_retry_count+1)
-            responses = responses + new_responses
+            requests_list (``iterable``): List or generator of dicts that each include a request function, its
+                parameters, and an optional expected status. These will be executed concurrently.
+        Keyword Args:
+            retry (``bool``, optional): Retry requests that failed with a 5xx status up to REQUEST_RETRIES times,
+                backing off between attempts. 429 and 503 are already retried by the session. Default is False.
+        """
+        # Keep at most 500 requests in flight. This prevents us from having tens or hundreds of thousands of pending
+        # requests with CallHub, while new requests are sent as soon as earlier ones finish instead of waiting for the
+        # slowest request of a whole batch
+        max_in_flight = 500
+        # Requests are pulled from requests_list only as there's room for them, so it can be a generator
+        requests_to_send = enumerate(requests_list)
+        in_flight = {}
+        responses = {}
+        failures = {}
+        # Seconds to wait before retrying each failure that's worth retrying
+        retry_delays = {}
+        while True:
+            for i, request in islice(requests_to_send, max_in_flight - len(in_flight)):
+                # Execute request asynchronously
+                in_flight[request["func"](**request["func_params"])] = (i, request)
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for req_awaiting_response in done:
+                i, request = in_flight.pop(req_awaiting_response)
+                response = req_awaiting_response.result()
+                try:
+                    if request["expected_status"] and response.status_code != int(request["expected_status"]):
+                        raise RuntimeError("Status code {} when making request to: "
+                                           "{}, expected {}. Details: {})".format(response.status_code,
+                                                                     request["func_params"]["url"],
+                                                                     request["expected_status"],
+                                                                     response.text))
+                    responses[i] = response
+
+                except RuntimeError as api_except:
+                    failures[i] = (request, api_except)
+                    # The session has already retried RETRY_STATUSES as long as it's willing to
+                    if response.status_code >= 500 and response.status_code not in self.RETRY_STATUSES:
+                        delay = retry_delay(response.headers.get("Retry-After"),
+                                            default=backoff_delay(current_retry_count))
+                        retry_delays[i] = min(delay, self.MAX_RETRY_DELAY)
+
+        # Responses and errors are returned in the order their requests were given
+        responses = [responses[i] for i in sorted(responses)]
+        errors = [failures[i] for i in sorted(failures)]
+
+        if retry_delays and retry and current_retry_count < self.REQUEST_RETRIES:
+            # Other failures (eg: 400 Bad Request) would only fail the same way again
+            errors = [failures[i] for i in sorted(failures) if i not in retry_delays]
+            time.sleep(max(retry_delays.values()))
+            failed_requests = [failures[i][0] for i in sorted(retry_delays)]
+            new_responses, new_errors = self._handle_requests(failed_requests, retry=True,
+                                                              current_retry_count=current_retry_count+1)
+            responses.extend(new_responses)
+            errors.extend(new_errors)
 
         return responses, errors
 
-    def get_dnc_lists(self):
+    def get_dnc_lists(self, force=False):
         """
-        Returns ids and names of all do-not-contact lists
+        Returns ids and names of all do-not-contact lists. DNC lists are cached for DNC_LISTS_CACHE_TTL seconds, so
+        formatting DNC data repeatedly doesn't fetch them again.
+        Keyword Args:
+            force (``bool``, optional): Fetch DNC lists from CallHub even if they're cached. Default is False.
         Returns:
             dnc_lists (``dict``): Dictionary of dnc lists where the key is the id and the value is the name
         """
-        dnc_lists = self._get_paged_data("{}/v1/dnc_lists/".format(self.api_domain))
-        return {dnc_list['url'].split("/")[-2]: dnc_list["name"] for dnc_list in dnc_lists}
+        now = time.monotonic()
+        if not force and self._dnc_lists_cache is not None and \
+                now - self._dnc_lists_cache_time < self.DNC_LISTS_CACHE_TTL:
+            return self._dnc_lists_cache
+        dnc_lists = self._iter_paged_data(self._endpoints["dnc_lists"])
+        self._dnc_lists_cache = {_id_from_url(dnc_list['url']): dnc_list["name"] for dnc_list in dnc_lists}
+        self._dnc_lists_cache_time = now
+        return self._dnc_lists_cache
 
     def pretty_format_dnc_data(self, dnc_contacts):
         dnc_lists = self.get_dnc_lists()
+        refreshed = False
         dnc_phones = defaultdict(list)
         for dnc_contact in dnc_contacts:
             phone = dnc_contact["phone_number"]
-            dnc_list_id = dnc_contact["dnc"].split("/")[-2]
-            dnc_contact_id = dnc_contact["url"].split("/")[-2]
+            dnc_list_id = _id_from_url(dnc_contact["dnc"])
+            dnc_contact_id = _id_from_url(dnc_contact["url"])
+            if dnc_list_id not in dnc_lists and not refreshed:
+                # The list may have been created elsewhere since DNC lists were cached
+                dnc_lists = self.get_dnc_lists(force=True)
+                refreshed = True
             dnc_list = {"list_id": dnc_list_id, "name": dnc_lists[dnc_list_id], "dnc_contact_id": dnc_contact_id}
             dnc_phones[phone].append(dnc_list)
         return dict(dnc_phones)
@@ -341,7 +639,8 @@ class CallHub:
                 >>>                                    {"list_id": 8794, "name": "SMS Campaign", "dnc_contact_id": 4567}
                 >>>                                 ]}}
         """
-        dnc_contacts = self._get_paged_data("{}/v1/dnc_contacts/".format(self.api_domain))
+        # Pages are formatted as they arrive rather than being collected into one list first
+        dnc_contacts = self._iter_paged_data(self._endpoints["dnc_contacts"])
         return self.pretty_format_dnc_data(dnc_contacts)
 
 
@@ -359,20 +658,42 @@ class CallHub:
             raise TypeError("add_dnc expects a list of phone numbers. If you intend to only add one number to the "
                             "do-not-contact list, add a list of length 1")
 
-        url = "{}/v1/dnc_contacts/".format(self.api_domain)
-        requests = []
-        for number in phone_numbers:
-            data = {"dnc": "{}/v1/dnc_lists/{}/".format(self.api_domain, dnc_list_id), 'phone_number': number}
-            requests.append({"func": self.session.post,
-                             "func_params": {"url": url, "data":data},
-                             "expected_status": 201})
+        url = self._endpoints["dnc_contacts"]
+        dnc_list_url = "{}{}/".format(self._endpoints["dnc_lists"], dnc_list_id)
+        requests = ({"func": self.session.post,
+                     "func_params": {"url": url, "data": {"dnc": dnc_list_url, 'phone_number': number}},
+                     "expected_status": 201} for number in phone_numbers)
 
         responses, errors = self._handle_requests(requests, retry=True)
-        dnc_records = [request.json() for request in responses]
-        results = self.pretty_format_dnc_data(dnc_records)
+        results = self.pretty_format_dnc_data(map(_json, responses))
         return results, errors
 
 
+    def _lookup_dnc_phones(self, numbers):
+        """
+        Internal function. Looks up the DNC entries of a few phone numbers and adds them to self.dnc_cache. Returns
+        False without touching the cache if CallHub's responses weren't filtered to those numbers, in which case the
+        whole cache has to be refreshed with get_dnc_phones instead.
+        """
+        url = self._endpoints["dnc_contacts"]
+        requests = ({"func": self.session.get,
+                     "func_params": {"url": url, "params": {"phone_number": number}},
+                     "expected_status": 200} for number in numbers)
+        responses, errors = self._handle_requests(requests)
+        if errors:
+            return False
+        dnc_contacts = []
+        for number, response in zip(numbers, responses):
+            page = _json(response)
+            # A filtered response fits on one page and only contains the number asked for
+            if page.get("next") or any(dnc_contact["phone_number"] != number for dnc_contact in page["results"]):
+                return False
+            dnc_contacts += page["results"]
+        dnc_phones = self.pretty_format_dnc_data(dnc_contacts)
+        for number in numbers:
+            self.dnc_cache[number] = dnc_phones.get(number, [])
+        return True
+
     def remove_dnc(self, numbers, dnc_list=None):
         """
         Removes phone numbers from do-not-contact list. CallHub's api does not support this, instead it only supports
@@ -390,9 +711,13 @@ class CallHub:
         Returns:
             errors (``list``): List of errors
         """
-        # Check if we need to refresh DNC phone numbers cache
-        if not set(numbers).issubset(set(self.dnc_cache.keys())):
-            self.dnc_cache = self.get_dnc_phones()
+        # Check if we need to refresh DNC phone numbers cache. A few missing numbers are looked up directly rather
+        # than fetching every DNC entry in the account again.
+        missing_numbers = [number for number in numbers if number not in self.dnc_cache]
+        if missing_numbers:
+            if (len(missing_numbers) > self.DNC_LOOKUP_RATIO * len(self.dnc_cache)
+                    or not self._lookup_dnc_phones(missing_numbers)):
+                self.dnc_cache = self.get_dnc_phones()
 
         dnc_ids_to_purge = []
         for number in numbers:
@@ -402,12 +727,10 @@ class CallHub:
                 elif not dnc_list:
                     dnc_ids_to_purge.append(dnc_entry["dnc_contact_id"])
 
-        url = "{}/v1/dnc_contacts/{}/"
-        requests = []
-        for dnc_id in dnc_ids_to_purge:
-            requests.append({"func": self.session.delete,
-                             "func_params": {"url": url.format(self.api_domain, dnc_id)},
-                             "expected_status": 204})
+        url = self._endpoints["dnc_contacts"] + "{}/"
+        requests = ({"func": self.session.delete,
+                     "func_params": {"url": url.format(dnc_id)},
+                     "expected_status": 204} for dnc_id in dnc_ids_to_purge)
         responses, errors = self._handle_requests(requests)
         return errors
 
@@ -419,7 +742,7 @@ class CallHub:
         Returns:
             id (``str``): ID of created dnc list
         """
-        url = "{}/v1/dnc_lists/".format(self.api_domain)
+        url = self._endpoints["dnc_lists"]
         responses, errors = self._handle_requests([{
             "func": self.session.post,
             "func_params": {"url": url, "data": {"name": name}},
@@ -427,7 +750,8 @@ class CallHub:
         }])
         if errors:
             raise RuntimeError(errors)
-        return responses[0].json()["url"].split("/")[-2]
+        self._dnc_lists_cache = None
+        return _id_from_url(_json(responses[0])["url"])
 
     def remove_dnc_list(self, id):
         """
@@ -435,12 +759,13 @@ class CallHub:
         Args:
             id (``str``): ID of DNC list to delete
         """
-        url = "{}/v1/dnc_lists/{}/"
+        url = self._endpoints["dnc_lists"] + "{}/"
         responses, errors = self._handle_requests([{
             "func": self.session.delete,
-            "func_params": {"url": url.format(self.api_domain, id)},
+            "func_params": {"url": url.format(id)},
             "expected_status": 204
         }])
+        self._dnc_lists_cache = None
         if errors:
             raise RuntimeError(errors)
 
@@ -451,12 +776,11 @@ class CallHub:
         Returns:
             campaigns (``dict``): list of campaigns
         """
-        url = "{}/v1/callcenter_campaigns/".format(self.api_domain)
+        url = self._endpoints["campaigns"]
         campaigns = self._get_paged_data(url)
         # Extract campaign id from url
-        for i, campaign in enumerate(campaigns):
-            id = campaign["url"].split("/")[-2]
-            campaigns[i]["id"] = id
+        for campaign in campaigns:
+            campaign["id"] = _id_from_url(campaign["url"])
         return campaigns
 
     def create_phonebook(self, name, description=""):
@@ -469,7 +793,7 @@ class CallHub:
         Returns:
             id (``str``): id of phonebook
         """
-        url = "{}/v1/phonebooks/".format(self.api_domain)
+        url = self._endpoints["phonebooks"]
         responses, errors = self._handle_requests([{
             "func": self.session.post,
             "func_params": {"url": url, "data": {"name": name, "description": description}},
@@ -477,8 +801,7 @@ class CallHub:
         }])
         if errors:
             raise RuntimeError(errors)
-        id = responses[0].json()["url"].split("/")[-2]
-        return id
+        return _id_from_url(_json(responses[0])["url"])
 
     def create_webhook(self, target, event="cc.notes"):
         """
@@ -490,7 +813,7 @@ class CallHub:
         Returns:
             id (``str``): id of created webhook
         """
-        url = "{}/v1/webhooks/".format(self.api_domain)
+        url = self._endpoints["webhooks"]
         responses, errors = self._handle_requests([{
             "func": self.session.post,
             "func_params": {"url": url, "data": {"target": target, "event": event}},
@@ -498,7 +821,7 @@ class CallHub:
         }])
         if errors:
             raise RuntimeError(errors)
-        return responses[0].json()["id"]
+        return _json(responses[0])["id"]
 
     def get_webhooks(self):
         """
@@ -506,7 +829,7 @@ class CallHub:
         Returns:
             webhooks (``dict``): list of webhooks
         """
-        url = "{}/v1/webhooks/".format(self.api_domain)
+        url = self._endpoints["webhooks"]
         webhooks = self._get_paged_data(url)
         return webhooks
 
@@ -516,7 +839,7 @@ class CallHub:
         Args:
             id (``str``): id of webhook to delete
         """
-        url = "{}/v1/webhooks/{}/".format(self.api_domain, id)
+        url = "{}{}/".format(self._endpoints["webhooks"], id)
         responses, errors = self._handle_requests([{
             "func": self.session.delete,
             "func_params": {"url": url},
@@ -537,7 +860,7 @@ class CallHub:
             url (``str``): download link for campaign
         """
         # Step 1: Request export of campaign
-        url = "{}/v1/power_campaign/{}/export/".format(self.api_domain, id)
+        url = "{}{}/export/".format(self._endpoints["power_campaigns"], id)
         responses, errors = self._handle_requests([{
             "func": self.session.post,
             "func_params": {"url": url},
@@ -545,7 +868,7 @@ class CallHub:
         }])
         if errors:
             raise RuntimeError(errors)
-        polling_url = responses[0].json()["polling_url"]
+        polling_url = _json(responses[0])["polling_url"]
 
         # Step 2: Continuously check if export is complete - 5 min maximum
         num_attempts_made = 0
@@ -559,7 +882,8 @@ class CallHub:
             }])
             if errors:
                 raise RuntimeError(errors)
-            state = responses[0].json()["state"]
+            export = _json(responses[0])
+            state = export["state"]
 
             num_attempts_made += 1
             if num_attempts_made == 300:
@@ -569,8 +893,8 @@ class CallHub:
             raise RuntimeError("CallHub reported an error trying to export the campaign. State: {}. "
                                "Full Response: {}".format(state, responses[0].text))
 
-        if responses[0].json()["data"]["code"] != 200:
+        if export["data"]["code"] != 200:
             raise RuntimeError("CallHub reported an error trying to export the campaign. "
                                "Full Response: {}".format(responses[0].text))
 
-        return responses[0].json()["data"]["url"]
\ No newline at end of file
+        return export["data"]["url"]
\ No newline at end of file
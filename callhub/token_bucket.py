@@ -0,0 +1,117 @@
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, calls, period, clock=time.monotonic, sleep=time.sleep):
+        """
+        Thread-safe token bucket used to rate limit requests to CallHub. The bucket holds at most ``calls`` tokens and
+        refills continuously at ``calls / period`` tokens per second.
+        >>> bucket = TokenBucket(calls=13, period=1)
+        >>> bucket.acquire()
+        Args:
+            calls (``int``): Number of calls allowed per period. This is also the largest burst allowed.
+            period (``float``): Length of the period in seconds
+        Keyword Args:
+            clock (``callable``, optional): Returns the current time in seconds. Default is time.monotonic.
+            sleep (``callable``, optional): Waits for a number of seconds. Default is time.sleep.
+        """
+        self.capacity = calls
+        self.rate = calls / period
+        self.tokens = calls
+        self.clock = clock
+        self.sleep = sleep
+        self.last_refill = clock()
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<TokenBucket {}/{}>".format(self.tokens, self.capacity)
+
+    def _refill(self):
+        """ Internal function to add the tokens that have accumulated since the last refill """
+        now = self.clock()
+        # last_refill is in the future while the bucket is paused
+        if now > self.last_refill:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+
+    def _time_until_token(self):
+        """ Internal function that returns the number of seconds until the next token is available """
+        return max(self.last_refill - self.clock(), 0) + (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Blocks until a token is available, then consumes it. Waiting threads are served one at a time, so concurrent
+        callers are spaced out evenly instead of all waking up at once.
+        """
+        with self.lock:
+            self._refill()
+            while self.tokens < 1:
+                self.sleep(self._time_until_token())
+                self._refill()
+            self.tokens -= 1
+
+    def pause(self, seconds):
+        """
+        Empties the bucket and stops it from refilling for the given number of seconds, eg: when CallHub asks us to
+        retry after a delay.
+        Args:
+            seconds (``float``): Number of seconds to pause for
+        """
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0)
+            self.last_refill = max(self.last_refill, self.clock() + seconds)
+
+    def sync_from_headers(self, headers, max_pause=None):
+        """
+        Updates the bucket from the RateLimit-Remaining and RateLimit-Reset headers of a response, if CallHub sent
+        them. The bucket is only ever drained to match the server, never filled past the configured limit.
+        Args:
+            headers (``dict``): Response headers
+        Keyword Args:
+            max_pause (``float``, optional): Longest pause RateLimit-Reset can cause, in seconds. Default is no limit.
+        """
+        try:
+            remaining = int(headers["RateLimit-Remaining"])
+        except (KeyError, ValueError):
+            return
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, remaining)
+        if remaining <= 0:
+            delay = retry_delay(headers.get("RateLimit-Reset"), default=1 / self.rate)
+            if max_pause is not None:
+                delay = min(delay, max_pause)
+            self.pause(delay)
+
+
+def retry_delay(value, default):
+    """
+    Parses a Retry-After or RateLimit-Reset header value, given in seconds
+    Args:
+        value (``str``): Header value, or None if the header was not sent
+        default (``float``): Delay to use if the header is missing or not a number of seconds
+    Returns:
+        delay (``float``): Number of seconds to wait
+    """
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        return default
+
+
+def backoff_delay(attempt, base=1, maximum=60):
+    """
+    Exponential backoff with jitter, for retrying requests when CallHub doesn't say how long to wait. The jitter keeps
+    requests that failed together from all being retried at the same moment.
+    Args:
+        attempt (``int``): Number of times the request has already been retried
+    Keyword Args:
+        base (``float``, optional): Delay before the first retry, before jitter. Default is 1.
+        maximum (``float``, optional): Largest delay, before jitter. Default is 60.
+    Returns:
+        delay (``float``): Number of seconds to wait
+    """
+    return min(maximum, base * 2 ** attempt) + random.uniform(0, base)
@@ -13,7 +13,10 @@ with open(os.path.join(here, "README.md"), mode="r") as f:
     README = f.read()
 
 tests_require = ["requests-mock"]
-install_requires = ["requests==2.23.0", "ratelimit==2.2.1", "requests-futures==1.0.0"]
+install_requires = ["requests==2.23.0", "requests-futures==1.0.0", "requests-toolbelt==0.9.1"]
+# orjson decodes responses faster when it's installed, but doesn't support Python 3.5. brotli lets CallHub send
+# smaller responses.
+extras_require = {"orjson": ["orjson; python_version >= '3.6'"], "brotli": ["brotli"]}
 
 setup(
     name=about["__name__"],
@@ -26,6 +29,7 @@ setup(
     version=about["__version__"],
     packages=["callhub"],
     install_requires=install_requires,
+    extras_require=extras_require,
     tests_requre=tests_require,
     python_requires=">=3.5",
     keywords=["callhub", "api"],
@@ -1,38 +1,32 @@
 import os
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from requests_mock import Mocker
 from callhub import CallHub
 
+# Agents listing for an account with only the default agent, whose owner is the admin
+AGENTS_JSON = {'count': 1,
+               'next': None,
+               'previous': None,
+               'results': [{'email': 'user@example.com',
+                            'id': 1111111111111111111,
+                            'owner': [{'url': 'https://api.callhub.io/v1/users/0/',
+                                       'username': 'admin@example.com'}],
+                            'teams': [],
+                            'username': 'defaultuser'}]
+               }
+
 
 class TestInit(unittest.TestCase):
     def create_callhub(self, api_key=None):
-        with Mocker() as mock:
-            mock.get("https://api.callhub.io/v1/agents/",
-                     status_code=200,
-                     json={'count': 1,
-                           'next': None,
-                           'previous': None,
-                           'results': [{'email': 'user@example.com',
-                                        'id': 1111111111111111111,
-                                        'owner': [{'url': 'https://api.callhub.io/v1/users/0/',
-                                                   'username': 'admin@example.com'}],
-                                        'teams': [],
-                                        'username': 'defaultuser'}]
-                           },
-                     complete_qs=True,
-                     )
-
-            return CallHub("https://api.callhub.io", api_key=api_key, rate_limit=False)
+        # Creating a CallHub object doesn't make any requests, the api key is only validated once it's needed
+        return CallHub("https://api.callhub.io", api_key=api_key, rate_limit=False)
 
     def setUp(self):
-        os.environ["CALLHUB_API_KEY"] = "123456789ABCDEF"
-
-    def tearDown(self):
-        try:
-            del os.environ['CALLHUB_API_KEY']
-        except:
-            pass
+        # Each test gets its own copy of the environment, so tests never leave CALLHUB_API_KEY changed behind them
+        environ = patch.dict(os.environ, {"CALLHUB_API_KEY": "123456789ABCDEF"})
+        environ.start()
+        self.addCleanup(environ.stop)
 
     def test_auth_failure(self):
         del os.environ['CALLHUB_API_KEY']
@@ -40,17 +34,7 @@ class TestInit(unittest.TestCase):
 
     def test_api_key_good(self):
         with Mocker() as mock:
-            mock.get("https://api.callhub.io/v1/agents/",
-                     json={'count': 1,
-                           'next': None,
-                           'previous': None,
-                           'results': [{'email': 'user@example.com',
-                                        'id': 1111111111111111111,
-                                        'owner': [{'url': 'https://api.callhub.io/v1/users/0/',
-                                                   'username': 'admin@example.com'}],
-                                        'teams': [],
-                                        'username': 'defaultuser'}]
-                           })
+            mock.get("https://api.callhub.io/v1/agents/", json=AGENTS_JSON)
             self.assertEqual(CallHub("https://api.callhub.io", api_key="G00D4P1K3Y").validate_api_key(), "admin@example.com")
 
     def test_api_key_good_no_users(self):
@@ -68,15 +52,29 @@ class TestInit(unittest.TestCase):
     def test_api_key_bad(self):
         with Mocker() as mock:
             mock.get("https://api.callhub.io/v1/agents/", json={'detail': 'Invalid token.'})
-            self.assertRaises(ValueError, CallHub, "https://api.callhub.io", api_key="B4D4P1K3Y")
+            self.assertRaises(ValueError, CallHub("https://api.callhub.io", api_key="B4D4P1K3Y").validate_api_key)
 
             mock.get("https://api.callhub.io/v1/agents/", json={'detail': 'User inactive or deleted.'})
-            self.assertRaises(ValueError, CallHub, "https://api.callhub.io", api_key="B4D4P1K3Y",)
+            self.assertRaises(ValueError, CallHub("https://api.callhub.io", api_key="B4D4P1K3Y").validate_api_key)
 
     def test_api_key_good_but_callhub_misbehaving(self):
         with Mocker() as mock:
             mock.get("https://api.callhub.io/v1/agents/", json={'garbagedata': 'callhub api misbehaving'})
-            self.assertRaises(RuntimeError, CallHub, "https://api.callhub.io", api_key="G00D4P1K3YBUTC4LLHUB1S4CT1NGUP")
+            callhub = CallHub("https://api.callhub.io", api_key="G00D4P1K3YBUTC4LLHUB1S4CT1NGUP")
+            self.assertRaises(RuntimeError, callhub.validate_api_key)
+
+    def test_api_key_validated_lazily(self):
+        with Mocker() as mock:
+            mock.get("https://api.callhub.io/v1/agents/", json={'detail': 'Invalid token.'})
+            callhub = CallHub("https://api.callhub.io", api_key="B4D4P1K3Y")
+            self.assertEqual(mock.call_count, 0)
+            with self.assertRaises(ValueError):
+                callhub.admin_email
+
+            mock.get("https://api.callhub.io/v1/agents/", json=AGENTS_JSON)
+            self.assertEqual(callhub.admin_email, "admin@example.com")
+            self.assertEqual(repr(callhub), "<CallHub admin: admin@example.com>")
+            self.assertEqual(mock.call_count, 2)
 
     def test_auth_env(self):
         self.assertIsInstance(self.create_callhub(), CallHub)
@@ -1,153 +1,457 @@
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from callhub import CallHub
+from callhub.bulk_upload_tools import SizedFile, csv_and_mapping_create, csv_create, mapping_create
+from callhub.token_bucket import TokenBucket, backoff_delay
+import callhub.callhub
 import time
+import threading
+from concurrent.futures import Future
 import math
 from requests_mock import Mocker
 import requests_mock
+from requests_futures.sessions import FuturesSession
+from requests_toolbelt.multipart.encoder import MultipartEncoder
+from urllib3.util.request import ACCEPT_ENCODING
+
+# Session methods as defined before any CallHub instance is created
+SESSION_METHODS = {name: getattr(FuturesSession, name) for name in ("send", "request", "get", "post", "delete")}
+
+# Phonebook and contacts used by tests that don't care about their contents
+SAMPLE_PHONEBOOK_ID = 2325931969109558581
+SAMPLE_CONTACTS = [{"first name": "james", "phone number": "5555555555"}]
+BULK_CREATE_URL = "https://api.callhub.io/v1/contacts/bulk_create/"
+# Urls of single CallHub resources, formatted with the resource's id
+DNC_LIST_URL = "https://api.callhub.io/v1/dnc_lists/{}/"
+PHONEBOOK_URL = "https://api.callhub.io/v1/phonebooks/{}/"
+WEBHOOK_URL = "https://api.callhub.io/v1/webhooks/{}/"
+
+# Responses that tests only read, so they're built once and shared
+FIELDS_JSON = {'count': 4, 'results': [{'id': 0, 'name': 'phone number'}, {'id': 1, 'name': 'mobile number'},
+                                       {'id': 2, 'name': 'last name'}, {'id': 3, 'name': 'first name'}]}
+LEADERBOARD_JSON = {"plot_data": [{'connecttime': 3300,
+                                   'teams': ['Fundraising'],
+                                   'calls': 5,
+                                   'agent': 'jimmybru',
+                                   'talktime': 120}]}
+BULK_CREATE_JSON = {"message": "'Import in progress. You will get an email when import is complete'"}
+# One page of contacts, from an account with 40 contacts
+CONTACTS_PAGE_JSON = {"count": 40, "results": [{"first name": "james"}, {"first name": "sumiya"}]}
+
+
+class FakeClock:
+    """ Clock for a TokenBucket that only moves when the bucket sleeps, so rate limits are tested without waiting """
+    def __init__(self):
+        # Kept in whole nanoseconds so that even the tiniest sleep moves the clock forward
+        self.nanoseconds = 0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.nanoseconds / 1e9
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.nanoseconds += math.ceil(seconds * 1e9)
 
 
 class TestInit(unittest.TestCase):
-    @classmethod
-    def setUp(cls):
-        cls.TESTING_API_LIMIT = {
-            "GENERAL": {"calls": 1, "period": 0.1},
-            "BULK_CREATE": {"calls": 1, "period": 0.2},
-        }
-        with Mocker() as mock:
-            mock.get("https://api.callhub.io/v1/agents/",
-                     status_code=200,
-                     json={'count': 1,
-                           'next': None,
-                           'previous': None,
-                           'results': [{'email': 'user@example.com',
-                                        'id': 1111111111111111111,
-                                        'owner': [{'url': 'https://api.callhub.io/v1/users/0/',
-                                                   'username': 'admin@example.com'}],
-                                        'teams': [],
-                                        'username': 'defaultuser'}]
-                           },
-                     )
-            # Create one callhub object stored in cls.callhub (for most test cases)
-            # Create ten callhub objects stored in cls.callhubs (for bulk testing)
-            cls.callhubs = []
-            for i in range(11):
-                callhub = CallHub("https://api.callhub.io", api_key="123456789ABCDEF", rate_limit=cls.TESTING_API_LIMIT)
-                # Override all http methods with mocking so a poorly designed test can't mess with
-                if i == 0:
-                    cls.callhub = callhub
-                else:
-                    cls.callhubs.append(callhub)
+    TESTING_API_LIMIT = {
+        "GENERAL": {"calls": 1, "period": 0.02},
+        # A power of two, so a fake clock can advance by exactly one period at a time
+        "BULK_CREATE": {"calls": 1, "period": 0.25},
+    }
+
+    def setUp(self):
+        # Creating a CallHub object doesn't make any requests, so each test gets its own and can't leak caches or
+        # rate limiter state into the next one
+        self.callhub = self.create_callhub()
+        # Bound now, since some tests swap self.callhub for another instance
+        self.addCleanup(self.callhub.session.close)
+
+    def create_callhub(self):
+        return CallHub("https://api.callhub.io", api_key="123456789ABCDEF", rate_limit=self.TESTING_API_LIMIT)
+
+    def use_fake_clocks(self, callhub):
+        # Replace the instance's rate limiters with ones that don't really sleep, and return their clocks
+        clocks = {}
+        for category, limit in self.TESTING_API_LIMIT.items():
+            clocks[category] = FakeClock()
+            callhub._rate_limiters[category] = TokenBucket(clock=clocks[category], sleep=clocks[category].sleep,
+                                                           **limit)
+        return clocks
+
+    def mock_fields(self, fields):
+        # Replace the account's fields, and don't start fetching the real ones in the background
+        self.callhub.fields = MagicMock(return_value=fields)
+        self.callhub._request_fields = MagicMock()
 
     def test_repr(self):
-        self.assertEqual("<CallHub admin: admin@example.com>", self.callhub.__repr__())
+        with Mocker() as mock:
+            mock.get("https://api.callhub.io/v1/agents/",
+                     json={'count': 1, 'results': [{'owner': [{'username': 'admin@example.com'}]}]})
+            self.assertEqual("<CallHub admin: admin@example.com>", self.callhub.__repr__())
 
     def test_agent_leaderboard(self):
         with Mocker() as mock:
-            mock.get("https://api.callhub.io/v1/analytics/agent-leaderboard/",
-                     status_code=200,
-                     json={
-                         "plot_data": [
-                             {
-                                 'connecttime': 3300,
-                                 'teams': ['Fundraising'],
-                                 'calls': 5,
-                                 'agent': 'jimmybru',
-                                 'talktime': 120
-                             }
-                         ]
-                     })
+            mock.get("https://api.callhub.io/v1/analytics/agent-leaderboard/", json=LEADERBOARD_JSON)
             leaderboard = self.callhub.agent_leaderboard("2019-12-30", "2020-12-30")
-            expected_leaderboard = [
-                {
-                    'connecttime': 3300,
-                    'teams': ['Fundraising'],
-                    'calls': 5,
-                    'agent': 'jimmybru',
-                    'talktime': 120
-                }
-            ]
-            self.assertEqual(leaderboard, expected_leaderboard)
+            self.assertEqual(leaderboard, LEADERBOARD_JSON["plot_data"])
 
     def test_bulk_create_success(self, test_specific_callhub_instance=None):
         with Mocker() as mock:
-            mock.post("https://api.callhub.io/v1/contacts/bulk_create/",
-                      status_code=200,
-                      json={"message": "'Import in progress. You will get an email when import is complete'"})
+            mock.post(BULK_CREATE_URL, status_code=200, json=BULK_CREATE_JSON)
             if test_specific_callhub_instance:
                 self.callhub = test_specific_callhub_instance
-            self.callhub.fields = MagicMock(return_value={"first name": 0, "phone number": 1})
-            result = self.callhub.bulk_create(
-                2325931969109558581,
-                [{"first name": "james", "phone number": "5555555555"}],
-                "CA")
+            self.mock_fields({"first name": 0, "phone number": 1})
+            result = self.callhub.bulk_create(SAMPLE_PHONEBOOK_ID, SAMPLE_CONTACTS, "CA")
             self.assertEqual(result, True)
 
+    def test_bulk_create_keeps_small_csv_in_memory(self):
+        csv_files = []
+
+        def recorded_csv_create(*args):
+            csv_files.append(csv_create(*args))
+            return csv_files[-1]
+
+        with Mocker() as mock, patch("callhub.callhub.csv_create", side_effect=recorded_csv_create):
+            mock.post(BULK_CREATE_URL, json=BULK_CREATE_JSON)
+            self.mock_fields({"first name": 0, "phone number": 1})
+            self.assertEqual(self.callhub.bulk_create(SAMPLE_PHONEBOOK_ID, SAMPLE_CONTACTS, "CA"), True)
+        # Uploading the CSV doesn't force it to be written to disk
+        self.assertFalse(csv_files[0]._rolled)
+
+        # The whole file is sent, and its length is known up front
+        with csv_create(SAMPLE_CONTACTS, ["first name", "phone number"]) as csv_file:
+            data = MultipartEncoder(fields={'contacts_csv': ('contacts.csv', SizedFile(csv_file), 'text/csv')})
+            self.assertFalse(csv_file._rolled)
+            body = data.to_string()
+            self.assertIn(b"james,5555555555\r\n", body)
+            self.assertEqual(data.len, len(body))
+
+    def test_bulk_create_case_insensitive_fields(self):
+        with Mocker() as mock:
+            mock.post(BULK_CREATE_URL, status_code=200, json=BULK_CREATE_JSON)
+            self.mock_fields({"First Name": 0, "phone number": 1})
+            with patch("callhub.callhub.csv_create", wraps=csv_create) as csv_create_mock:
+                with patch("callhub.callhub.mapping_create", wraps=mapping_create) as mapping_create_mock:
+                    result = self.callhub.bulk_create(
+                        SAMPLE_PHONEBOOK_ID,
+                        [{"FIRST NAME": "james", "Phone Number": "5555555555"}],
+                        "CA")
+            self.assertEqual(result, True)
+            csv_create_mock.assert_called_once_with([{"first name": "james", "phone number": "5555555555"}],
+                                                    ["first name", "phone number"])
+            mapping_create_mock.assert_called_once_with(["first name", "phone number"],
+                                                        {"first name": 0, "phone number": 1})
+
+    def test_bulk_create_fetches_fields_while_building_csv(self):
+        with Mocker() as mock:
+            fields = mock.get('https://api.callhub.io/v1/contacts/fields/',
+                              json={'count': 2, 'results': [{'id': 0, 'name': 'First Name'},
+                                                            {'id': 1, 'name': 'phone number'}]})
+            mock.post(BULK_CREATE_URL, json=BULK_CREATE_JSON)
+            fields_pending = []
+
+            def checked_csv_create(*args):
+                # The fields request has already been sent when the CSV is built
+                fields_pending.append(self.callhub._fields_future is not None)
+                return csv_create(*args)
+
+            with patch("callhub.callhub.csv_create", side_effect=checked_csv_create):
+                self.assertEqual(self.callhub.bulk_create(SAMPLE_PHONEBOOK_ID, SAMPLE_CONTACTS, "CA"), True)
+            self.assertEqual(fields_pending, [True])
+            self.assertEqual(fields.call_count, 1)
+
+    def test_csv_and_mapping_create(self):
+        contacts = [{"first name": "james", "phone number": "5555555555"},
+                    {"phone number": "5554443333", "last name": ""}]
+        fields = {"first name": 0, "phone number": 1, "last name": 2}
+        csv_file, mapping = csv_and_mapping_create(contacts, fields)
+        with csv_file:
+            self.assertEqual(csv_file.read(), b"james,5555555555,,\r\n,5554443333,,\r\n")
+        self.assertEqual(mapping, '{"0": "0", "1": "1", "2": "2"}')
+
+        # Field ids can be larger than the number of fields
+        csv_file, mapping = csv_and_mapping_create(contacts, {"phone number": 3})
+        with csv_file:
+            self.assertEqual(csv_file.read(), b",,,5555555555,\r\n,,,5554443333,\r\n")
+        self.assertEqual(mapping, '{"3": "3"}')
+
+        # Columns can also be given in any order, with the mapping created separately once fields are known
+        columns = ["phone number", "first name"]
+        with csv_create(contacts, columns) as csv_file:
+            self.assertEqual(csv_file.read(), b"5555555555,james\r\n5554443333,\r\n")
+        self.assertEqual(mapping_create(columns, fields), '{"1": "0", "0": "1"}')
+
+    def test_csv_create_in_chunks(self):
+        contacts = [{"first name": "james", "phone number": "555555555{}".format(i)} for i in range(5)]
+        columns = ["phone number", None, "first name"]
+        # Rows split across several chunks are written in order, with none lost at the chunk boundaries
+        with patch("callhub.bulk_upload_tools.CSV_CHUNK_ROWS", 2):
+            with csv_create(contacts, columns) as csv_file:
+                self.assertEqual(csv_file.read(), b"".join("555555555{},,james\r\n".format(i).encode()
+                                                           for i in range(5)))
+
     def test_bulk_create_field_mismatch_failure(self):
-        self.callhub.fields = MagicMock(return_value={"foo": 0, "bar": 1})
-        self.assertRaises(LookupError,
-                          self.callhub.bulk_create,
-                          2325931969109558581,
-                          [{"first name": "james", "phone number": "5555555555"}],
-                          "CA"
-                          )
+        self.mock_fields({"foo": 0, "bar": 1})
+        with self.assertRaises(LookupError):
+            self.callhub.bulk_create(SAMPLE_PHONEBOOK_ID, SAMPLE_CONTACTS, "CA")
+        # The error names the fields that are missing
+        with self.assertRaisesRegex(LookupError, r"missing from account: \['first name'\]"):
+            self.callhub.bulk_create(SAMPLE_PHONEBOOK_ID, [{"first name": "james", "foo": "5555555555"}], "CA")
 
     def test_bulk_create_api_exceeded_or_other_failure(self):
+        failure_bodies = [{"detail": "Request was throttled."},
+                          {"NON STANDARD KEY": "YOU MESSED UP FOR SOME REASON"}]
+        self.mock_fields({"first name": 0, "phone number": 1})
         with Mocker() as mock:
-            mock.post("https://api.callhub.io/v1/contacts/bulk_create/",
-                      json={"detail": "Request was throttled."})
-            self.callhub.fields = MagicMock(return_value={"first name": 0, "phone number": 1})
-            self.assertRaises(RuntimeError,
-                              self.callhub.bulk_create,
-                              2325931969109558581,
-                              [{"first name": "james", "phone number": "5555555555"}],
-                              "CA"
-                              )
-            mock.post("https://api.callhub.io/v1/contacts/bulk_create/",
-                      json={"NON STANDARD KEY": "YOU MESSED UP FOR SOME REASON"})
-            self.assertRaises(RuntimeError,
-                              self.callhub.bulk_create,
-                              2325931969109558581,
-                              [{"first name": "james", "phone number": "5555555555"}],
-                              "CA"
-                              )
+            for body in failure_bodies:
+                with self.subTest(body=body):
+                    mock.post(BULK_CREATE_URL, json=body)
+                    with self.assertRaises(RuntimeError):
+                        self.callhub.bulk_create(SAMPLE_PHONEBOOK_ID, SAMPLE_CONTACTS, "CA")
 
     def test_bulk_create_rate_limit(self):
-        start = time.perf_counter()
+        clocks = self.use_fake_clocks(self.callhub)
         num_iterations = 11
         for i in range(num_iterations):
             self.test_bulk_create_success()
-        stop = time.perf_counter()
 
-        # Should run within 95% to 105% of ratelimit*num iterations -1
-        lower_bound = 0.95 * self.TESTING_API_LIMIT["BULK_CREATE"]["period"] * (num_iterations - 1)
-        upper_bound = 1.05 * self.TESTING_API_LIMIT["BULK_CREATE"]["period"] * (num_iterations - 1)
-        self.assertEqual(lower_bound <= stop - start <= upper_bound, True)
+        # Every call after the first waits exactly once, for one full period
+        period = self.TESTING_API_LIMIT["BULK_CREATE"]["period"]
+        self.assertEqual(clocks["BULK_CREATE"].sleeps, [period] * (num_iterations - 1))
+
+    def test_token_bucket_only_waits_when_empty(self):
+        clock = FakeClock()
+        bucket = TokenBucket(calls=4, period=1, clock=clock, sleep=clock.sleep)
+        for i in range(4):
+            bucket.acquire()
+        # A full bucket allows a burst of calls without waiting
+        self.assertEqual(clock.sleeps, [])
+
+        for i in range(4):
+            bucket.acquire()
+        self.assertEqual(clock.sleeps, [0.25] * 4)
+
+        # Tokens accumulate while nothing is acquired, up to the bucket's capacity
+        clock.sleep(10)
+        for i in range(4):
+            bucket.acquire()
+        self.assertEqual(len(clock.sleeps), 5)
+        bucket.acquire()
+        self.assertEqual(clock.sleeps[-1], 0.25)
 
     def test_bulk_create_many_objects_rate_limit(self):
-        start = time.perf_counter()
+        instances = [self.create_callhub() for i in range(10)]
+        for instance in instances:
+            self.addCleanup(instance.session.close)
+        clocks = [self.use_fake_clocks(instance) for instance in instances]
         num_iterations = 11
         for i in range(num_iterations):
-            for callhub in self.callhubs:
-                self.test_bulk_create_success(test_specific_callhub_instance=callhub)
-        stop = time.perf_counter()
-        # num_iterations tests on n CallHub objects should run in almost exactly num_iterations*(ratelimit-1)
-        # because the rate limiting should be on a per-object basis.
-        lower_bound = 0.95 * self.TESTING_API_LIMIT["BULK_CREATE"]["period"] * (num_iterations - 1)
-        upper_bound = 1.05 * self.TESTING_API_LIMIT["BULK_CREATE"]["period"] * (num_iterations - 1)
-        self.assertEqual(lower_bound <= stop - start <= upper_bound, True)
+            for instance in instances:
+                self.test_bulk_create_success(test_specific_callhub_instance=instance)
+        # Rate limiting is on a per-object basis, so each object only waits for its own earlier calls
+        period = self.TESTING_API_LIMIT["BULK_CREATE"]["period"]
+        for callhub_clocks in clocks:
+            self.assertEqual(callhub_clocks["BULK_CREATE"].sleeps, [period] * (num_iterations - 1))
+
+    def test_connection_pool_matches_workers(self):
+        instance = CallHub("https://api.callhub.io", api_key="123456789ABCDEF", rate_limit=False)
+        self.addCleanup(instance.session.close)
+        self.assertEqual(instance.session.get_adapter("https://api.callhub.io")._pool_maxsize, 43)
+
+    def test_accept_encoding(self):
+        with Mocker() as mock:
+            mock.get("https://api.callhub.io/v1/webhooks/", json={})
+            self.callhub.session.get("https://api.callhub.io/v1/webhooks/").result()
+            self.assertEqual(mock.last_request.headers["Accept-Encoding"], ACCEPT_ENCODING)
+
+    def test_rate_limit_is_per_instance(self):
+        # Rate limiting must only wrap each instance's own session, never requests/FuturesSession globally
+        for name, method in SESSION_METHODS.items():
+            self.assertIs(getattr(FuturesSession, name), method)
+        other_callhub = self.create_callhub()
+        self.addCleanup(other_callhub.session.close)
+        self.assertIsNot(self.callhub.session, other_callhub.session)
+        self.assertIs(self.callhub.session.callhub, self.callhub)
+        self.assertIsNot(self.callhub._rate_limiters["GENERAL"], other_callhub._rate_limiters["GENERAL"])
+
+    def test_general_rate_limit_does_not_block_submission(self):
+        num_requests = 5
+        with Mocker() as mock:
+            mock.get("https://api.callhub.io/v1/webhooks/", status_code=200, json={})
+            start = time.perf_counter()
+            futures = [self.callhub.session.get("https://api.callhub.io/v1/webhooks/") for i in range(num_requests)]
+            submitted = time.perf_counter()
+            for future in futures:
+                future.result()
+            stop = time.perf_counter()
+
+        # Submitting requests should return immediately, while the requests themselves are still rate limited
+        self.assertLess(submitted - start, self.TESTING_API_LIMIT["GENERAL"]["period"])
+        lower_bound = 0.95 * self.TESTING_API_LIMIT["GENERAL"]["period"] * (num_requests - 1)
+        self.assertGreaterEqual(stop - start, lower_bound)
+
+    def test_throttled_request_retried(self):
+        with Mocker() as mock:
+            mock.get("https://api.callhub.io/v1/webhooks/",
+                     [{"status_code": 429, "headers": {"Retry-After": "0.2"}},
+                      {"status_code": 200, "json": {"count": 0, "results": []}}])
+            start = time.perf_counter()
+            response = self.callhub.session.get("https://api.callhub.io/v1/webhooks/").result()
+            stop = time.perf_counter()
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(mock.call_count, 2)
+            self.assertGreaterEqual(stop - start, 0.2)
+
+            # Give up after MAX_THROTTLED_RETRIES and return the throttled response
+            mock.get("https://api.callhub.io/v1/webhooks/", status_code=429, headers={"Retry-After": "0"})
+            self.callhub.MAX_THROTTLED_RETRIES = 2
+            response = self.callhub.session.get("https://api.callhub.io/v1/webhooks/").result()
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(mock.call_count, 5)
+
+    def test_unavailable_request_retried(self):
+        with Mocker() as mock:
+            mock.delete("https://api.callhub.io/v1/dnc_contacts/1/",
+                        [{"status_code": 503, "headers": {"Retry-After": "0"}},
+                         {"status_code": 204}])
+            response = self.callhub.session.delete("https://api.callhub.io/v1/dnc_contacts/1/").result()
+            self.assertEqual(response.status_code, 204)
+            self.assertEqual(mock.call_count, 2)
+
+        # Without Retry-After, back off exponentially with jitter
+        with patch("callhub.callhub.backoff_delay", return_value=0.2) as backoff, Mocker() as mock:
+            mock.delete("https://api.callhub.io/v1/dnc_contacts/2/", [{"status_code": 503}, {"status_code": 204}])
+            start = time.perf_counter()
+            response = self.callhub.session.delete("https://api.callhub.io/v1/dnc_contacts/2/").result()
+            stop = time.perf_counter()
+            self.assertEqual(response.status_code, 204)
+            backoff.assert_called_once_with(0)
+            self.assertGreaterEqual(stop - start, 0.2)
+
+    def test_backoff_delay(self):
+        with patch("random.uniform", return_value=0.5):
+            self.assertEqual(backoff_delay(0), 1.5)
+            self.assertEqual(backoff_delay(3), 8.5)
+            self.assertEqual(backoff_delay(10), 60.5)
+
+    def test_rate_limit_synced_from_headers(self):
+        with Mocker() as mock:
+            mock.get("https://api.callhub.io/v1/webhooks/", status_code=200, json={},
+                     headers={"RateLimit-Remaining": "0", "RateLimit-Reset": "0.3"})
+            self.callhub.session.get("https://api.callhub.io/v1/webhooks/").result()
+            start = time.perf_counter()
+            self.callhub.session.get("https://api.callhub.io/v1/webhooks/").result()
+            stop = time.perf_counter()
+            self.assertGreaterEqual(stop - start, 0.3)
+
+    def test_rate_limit_pause_capped(self):
+        # However long CallHub asks to wait, requests on the session are held back for at most MAX_RETRY_DELAY
+        clock = self.use_fake_clocks(self.callhub)["GENERAL"]
+        with Mocker() as mock:
+            mock.get("https://api.callhub.io/v1/webhooks/",
+                     [{"status_code": 429, "headers": {"Retry-After": "1e9"}},
+                      {"status_code": 200, "json": {}, "headers": {"RateLimit-Remaining": "0",
+                                                                   "RateLimit-Reset": "1e9"}},
+                      {"status_code": 200, "json": {}}])
+            self.assertEqual(self.callhub.session.get("https://api.callhub.io/v1/webhooks/").result().status_code, 200)
+            self.callhub.session.get("https://api.callhub.io/v1/webhooks/").result()
+            self.assertEqual(mock.call_count, 3)
+        self.assertEqual(len(clock.sleeps), 2)
+        for seconds in clock.sleeps:
+            # Waiting for the pause to end, and then for the next token
+            self.assertLess(seconds, self.callhub.MAX_RETRY_DELAY + 1)
+
+        bucket = TokenBucket(calls=1, period=1, clock=clock, sleep=clock.sleep)
+        bucket.sync_from_headers({"RateLimit-Remaining": "0", "RateLimit-Reset": "1e9"}, max_pause=5)
+        bucket.acquire()
+        # Five seconds paused, then one more for the next token
+        self.assertAlmostEqual(clock.sleeps[-1], 6)
 
     def test_fields(self):
         with Mocker() as mock:
-            mock.get('https://api.callhub.io/v1/contacts/fields/',
-                     json={'count': 4, 'results':
-                         [{'id': 0, 'name': 'phone number'}, {'id': 1, 'name': 'mobile number'},
-                          {'id': 2, 'name': 'last name'}, {'id': 3, 'name': 'first name'}]})
+            mock.get('https://api.callhub.io/v1/contacts/fields/', json=FIELDS_JSON)
             self.assertEqual(self.callhub.fields(),
                              {'phone number': 0, 'mobile number': 1, 'last name': 2, 'first name': 3})
 
+    def test_json_without_orjson(self):
+        with Mocker() as mock:
+            mock.get("https://api.callhub.io/v1/contacts/fields/", status_code=200,
+                     json={"count": 1, "results": [{"id": 0, "name": "first name"}]})
+            with patch.object(callhub.callhub, "orjson", None):
+                self.assertEqual(self.callhub.fields(), {"first name": 0})
+
+    def test_fields_cached(self):
+        with Mocker() as mock:
+            mock.get('https://api.callhub.io/v1/contacts/fields/',
+                     json={'count': 1, 'results': [{'id': 0, 'name': 'phone number'}]})
+            self.assertEqual(self.callhub.fields(), {'phone number': 0})
+            self.assertEqual(self.callhub.fields(), {'phone number': 0})
+            self.assertEqual(mock.call_count, 1)
+
+            # Fields are fetched again once the cache expires
+            self.callhub._fields_cache_time -= self.callhub.FIELDS_CACHE_TTL
+            self.assertEqual(self.callhub.fields(), {'phone number': 0})
+            self.assertEqual(mock.call_count, 2)
+
+            # Or when they're fetched with force
+            self.assertEqual(self.callhub.fields(force=True), {'phone number': 0})
+            self.assertEqual(mock.call_count, 3)
+
+            # Checking fields uses the cache too
+            self.assertEqual(self.callhub._assert_fields_exist([{"Phone Number": "5555555555"}]), {'phone number': 0})
+            self.assertRaises(LookupError, self.callhub._assert_fields_exist, [{"first name": "james"}])
+            self.assertEqual(mock.call_count, 3)
+
+            # bulk_create gets fields once, to both check and map them
+            mock.post(BULK_CREATE_URL, json=BULK_CREATE_JSON)
+            self.mock_fields({"phone number": 0})
+            self.callhub.bulk_create(SAMPLE_PHONEBOOK_ID, [{"phone number": "5555555555"}], "CA")
+            self.callhub.fields.assert_called_once_with()
+
+    def test_prefetch_fields(self):
+        with Mocker() as mock:
+            mock.get("https://api.callhub.io/v1/agents/", json={'count': 0, 'results': []})
+            mock.get('https://api.callhub.io/v1/contacts/fields/',
+                     json={'count': 1, 'results': [{'id': 0, 'name': 'phone number'}]})
+            instance = CallHub("https://api.callhub.io", api_key="123456789ABCDEF", rate_limit=self.TESTING_API_LIMIT,
+                               prefetch_fields=True)
+            self.addCleanup(instance.session.close)
+            self.assertEqual(instance.fields(), {'phone number': 0})
+            # Fields were only requested once, by the constructor
+            self.assertEqual([request.path for request in mock.request_history], ["/v1/contacts/fields/"])
+
+        with Mocker() as mock:
+            fields = mock.get('https://api.callhub.io/v1/contacts/fields/',
+                              [{"json": {'count': 1, 'results': [{'id': 0, 'name': 'phone number'}]}},
+                               {"json": {'count': 1, 'results': [{'id': 1, 'name': 'first name'}]}}])
+            instance = CallHub("https://api.callhub.io", api_key="123456789ABCDEF", rate_limit=self.TESTING_API_LIMIT,
+                               prefetch_fields=True)
+            self.addCleanup(instance.session.close)
+            instance._fields_future.result()
+            # Fields changed after they were prefetched, force doesn't reuse the prefetched response
+            self.assertEqual(instance.fields(force=True), {'first name': 1})
+            self.assertEqual(fields.call_count, 2)
+
+        with Mocker() as mock:
+            fields = mock.get('https://api.callhub.io/v1/contacts/fields/',
+                              json={'count': 1, 'results': [{'id': 0, 'name': 'phone number'}]})
+            with patch("callhub.callhub.time.monotonic", return_value=1000):
+                instance = CallHub("https://api.callhub.io", api_key="123456789ABCDEF",
+                                   rate_limit=self.TESTING_API_LIMIT, prefetch_fields=True)
+            self.addCleanup(instance.session.close)
+            instance._fields_future.result()
+            # Prefetched fields expire FIELDS_CACHE_TTL after they were requested, not after they were first used
+            with patch("callhub.callhub.time.monotonic", return_value=1000 + instance.FIELDS_CACHE_TTL - 1):
+                self.assertEqual(instance.fields(), {'phone number': 0})
+            self.assertEqual(fields.call_count, 1)
+            with patch("callhub.callhub.time.monotonic", return_value=1000 + instance.FIELDS_CACHE_TTL):
+                self.assertEqual(instance.fields(), {'phone number': 0})
+            self.assertEqual(fields.call_count, 2)
+
     def test_collect_fields(self):
-        contacts = [{"first name": "James", "contact": 5555555555}, {"last name": "Brunet", "contact": 1234567890}]
+        contacts = [{"First Name": "James", "contact": 5555555555}, {"last name": "Brunet", "CONTACT": 1234567890}]
         self.assertEqual(self.callhub._collect_fields(contacts), {"first name", "last name", "contact"})
 
     def test_create_contact(self):
@@ -156,54 +460,158 @@ class TestInit(unittest.TestCase):
             mock.post('https://api.callhub.io/v1/contacts/', json={"id": expected_id}, status_code=201)
 
             # Test if contact creation successful
-            self.callhub.fields = MagicMock(return_value={"first name": 0, "phone number": 1})
+            self.mock_fields({"first name": 0, "phone number": 1})
             contact_id = self.callhub.create_contact({"first name": "Jimmy", "phone number": "5555555555"})
             self.assertEqual(contact_id, expected_id)
 
             # Ensure contact creation fails on field mismatch
-            self.callhub.fields = MagicMock(return_value={"foo": 0, "bar": 1})
-            self.assertRaises(LookupError,
-                              self.callhub.create_contact,
-                              {"first name": "james", "phone number": "5555555555"},
-                              )
-
-    def get_all_contacts(self, limit, count, status=200):
-        page_json = {
-            "count": count,
-            "results": [
-                {"first name": "james"},
-                {"first name": "sumiya"}
-            ]
-        }
-        expected_result = page_json["results"].copy()
-        # We expect get_contacts to fetch either the limit/page_size pages or the total/page_size pages, depending
-        # on which is smaller
-        expected_result *= min(math.ceil(limit / len(page_json["results"])),
-                               math.ceil(count / len(page_json["results"])))
-        # We then expect get_contacts to trim the result to exactly the limit (because we fetch in batches equal to the
-        # page size but the limit is for the exact number of contacts)
-        expected_result = expected_result[:limit]
-        with Mocker() as mock:
-            mock.get('https://api.callhub.io/v1/contacts/', status_code=status, json=page_json)
-            # Test number of contacts matches size given
-            self.assertEqual(len(self.callhub.get_contacts(limit)), min(limit, count))
-            # Test that the results of get_contacts match the expected results
-            self.assertEqual(self.callhub.get_contacts(limit), expected_result)
+            self.mock_fields({"foo": 0, "bar": 1})
+            with self.assertRaises(LookupError):
+                self.callhub.create_contact(SAMPLE_CONTACTS[0])
 
     def test_get_all_contacts(self):
-        # Test different variations of get_all_contacts with different numbers of contacts and different limits
-        # Test when no contacts exist
-        self.get_all_contacts(limit=50, count=0)
-        # Test when limit is zero
-        self.get_all_contacts(limit=0, count=50)
-        # Test when limit > contacts
-        self.get_all_contacts(limit=50, count=40)
-        # Test with odd number limit
-        self.get_all_contacts(limit=49, count=55)
-        # Test with even number limit
-        self.get_all_contacts(limit=50, count=55)
-        # Test with 500 error
-        self.assertRaises(RuntimeError, self.get_all_contacts, limit=50, count=50, status=500)
+        # Test get_contacts with different numbers of contacts and different limits
+        cases = [
+            # No contacts exist
+            {"limit": 50, "count": 0},
+            # Limit is zero
+            {"limit": 0, "count": 50},
+            # Limit > contacts
+            {"limit": 50, "count": 40},
+            # Odd number limit
+            {"limit": 49, "count": 55},
+            # Even number limit
+            {"limit": 50, "count": 55},
+        ]
+        with Mocker() as mock:
+            for case in cases:
+                with self.subTest(**case):
+                    limit, count = case["limit"], case["count"]
+                    # Every page returns the same results, and get_contacts trims them to exactly the limit or the
+                    # total, whichever is smaller
+                    page_size = len(CONTACTS_PAGE_JSON["results"])
+                    expected_result = [CONTACTS_PAGE_JSON["results"][i % page_size] for i in range(min(limit, count))]
+                    mock.get('https://api.callhub.io/v1/contacts/', json=dict(CONTACTS_PAGE_JSON, count=count))
+                    contacts = self.callhub.get_contacts(limit)
+                    # Test number of contacts matches size given
+                    self.assertEqual(len(contacts), min(limit, count))
+                    # Test that the results of get_contacts match the expected results
+                    self.assertEqual(contacts, expected_result)
+
+            # Test with 500 error
+            mock.get('https://api.callhub.io/v1/contacts/', status_code=500, json={"count": 50, "results": []})
+            self.assertRaises(RuntimeError, self.callhub.get_contacts, 50)
+
+    def test_handle_requests_errors_match_requests(self):
+        with Mocker() as mock:
+            mock.get("https://api.callhub.io/v1/ok/", status_code=200)
+            mock.get("https://api.callhub.io/v1/missing/", status_code=404)
+            requests_list = [{"func": self.callhub.session.get,
+                              "func_params": {"url": "https://api.callhub.io/v1/{}/".format(path)},
+                              "expected_status": 200} for path in ("missing", "ok", "ok")]
+            responses, errors = self.callhub._handle_requests(requests_list)
+            self.assertEqual([response.status_code for response in responses], [200, 200])
+            self.assertEqual(len(errors), 1)
+            self.assertIs(errors[0][0], requests_list[0])
+
+            # Requests can also be given lazily
+            responses, errors = self.callhub._handle_requests(iter(requests_list))
+            self.assertEqual(len(responses), 2)
+            self.assertIs(errors[0][0], requests_list[0])
+
+    def test_handle_requests_retries_server_errors(self):
+        url = "https://api.callhub.io/v1/dnc_contacts/"
+        requests_list = [{"func": self.callhub.session.post, "func_params": {"url": url}, "expected_status": 201}]
+        with patch("callhub.callhub.backoff_delay", return_value=0) as backoff, Mocker() as mock:
+            mock.post(url, [{"status_code": 500}, {"status_code": 502}, {"status_code": 201}])
+            responses, errors = self.callhub._handle_requests(requests_list, retry=True)
+            self.assertEqual([response.status_code for response in responses], [201])
+            self.assertEqual(errors, [])
+            self.assertEqual([call[0] for call in backoff.call_args_list], [(0,), (1,)])
+
+            # Give up after REQUEST_RETRIES
+            mock.post(url, status_code=500)
+            responses, errors = self.callhub._handle_requests(requests_list, retry=True)
+            self.assertEqual(len(errors), 1)
+            self.assertEqual(mock.call_count, 3 + self.callhub.REQUEST_RETRIES + 1)
+
+            # Client errors would fail the same way again, so they aren't retried
+            mock.post(url, status_code=400)
+            responses, errors = self.callhub._handle_requests(requests_list, retry=True)
+            self.assertEqual(len(errors), 1)
+            self.assertEqual(mock.call_count, 3 + self.callhub.REQUEST_RETRIES + 2)
+
+            # Throttled and unavailable responses were already retried by the session, so they aren't retried again
+            self.callhub.MAX_THROTTLED_RETRIES = 0
+            for status in (429, 503):
+                mock.reset_mock()
+                mock.post(url, status_code=status, headers={"Retry-After": "0"})
+                responses, errors = self.callhub._handle_requests(requests_list, retry=True)
+                self.assertEqual(len(errors), 1)
+                self.assertEqual(mock.call_count, 1)
+
+        # However long CallHub asks to wait, retries wait at most MAX_RETRY_DELAY
+        with patch("callhub.callhub.time.sleep") as sleep, Mocker() as mock:
+            mock.post(url, [{"status_code": 500, "headers": {"Retry-After": "3600"}}, {"status_code": 201}])
+            responses, errors = self.callhub._handle_requests(requests_list, retry=True)
+            self.assertEqual(errors, [])
+            sleep.assert_called_once_with(self.callhub.MAX_RETRY_DELAY)
+
+    def test_handle_requests_sends_concurrently(self):
+        # Every request, including the first, should be sent before waiting for any response
+        futures = [Future() for i in range(5)]
+        sent = []
+
+        def send(index):
+            sent.append(index)
+            return futures[index]
+
+        def respond():
+            sent_before_response.append(len(sent))
+            for future in futures:
+                future.set_result(MagicMock(status_code=200))
+        sent_before_response = []
+        threading.Timer(0.1, respond).start()
+        requests_list = [{"func": send, "func_params": {"index": i}, "expected_status": 200} for i in range(5)]
+        responses, errors = self.callhub._handle_requests(requests_list)
+        self.assertEqual(sent_before_response, [5])
+        self.assertEqual(len(responses), 5)
+
+    def test_iter_contacts(self):
+        with Mocker() as mock:
+            mock.get('https://api.callhub.io/v1/contacts/', status_code=200, json=CONTACTS_PAGE_JSON)
+            self.callhub.PAGES_IN_FLIGHT = 3
+            contacts = self.callhub.iter_contacts()
+            # Only the first page and the pages in flight are requested until the caller reads further
+            self.assertEqual(next(contacts), {"first name": "james"})
+            self.assertEqual(next(contacts), {"first name": "sumiya"})
+            # Closing cancels the pages in flight, waiting for any that were already being sent
+            contacts.close()
+            self.assertLessEqual(mock.call_count, 4)
+            self.assertEqual(len(self.callhub.get_contacts()), 40)
+
+    def test_get_paged_data_requests_each_page_once(self):
+        page_json = {"count": 5, "results": [{"id": 1}, {"id": 2}]}
+        with Mocker() as mock:
+            mock.get("https://api.callhub.io/v1/paged/", status_code=200, json=page_json)
+            self.assertEqual(len(self.callhub._get_paged_data("https://api.callhub.io/v1/paged/")), 5)
+            pages = sorted(request.qs["page"][0] for request in mock.request_history)
+            self.assertEqual(pages, ["1", "2", "3"])
+
+            # The second time, every page is requested along with the first, and a limit cuts the guess short
+            self.assertEqual(len(self.callhub._get_paged_data("https://api.callhub.io/v1/paged/")), 5)
+            self.assertEqual(len(self.callhub._get_paged_data("https://api.callhub.io/v1/paged/", limit=3)), 3)
+            pages = sorted(request.qs["page"][0] for request in mock.request_history)
+            self.assertEqual(pages, ["1", "1", "1", "2", "2", "2", "3", "3"])
+
+            # An endpoint that fit on a single page last time isn't speculatively asked for its second page
+            single_page = mock.get("https://api.callhub.io/v1/single_page/", status_code=200,
+                                   json={"count": 1, "results": [{}]})
+            self.callhub._get_paged_data("https://api.callhub.io/v1/single_page/")
+            # The second page was guessed the first time, and sent unless it was cancelled in time
+            call_count = single_page.call_count
+            self.callhub._get_paged_data("https://api.callhub.io/v1/single_page/")
+            self.assertEqual(single_page.call_count, call_count + 1)
 
     def test_get_dnc_lists(self):
         expected_result = {
@@ -231,6 +639,43 @@ class TestInit(unittest.TestCase):
             mock.get('https://api.callhub.io/v1/dnc_lists/', status_code=200, json=callhub_api_json)
             self.assertEqual(self.callhub.get_dnc_lists(), expected_result)
 
+            # DNC lists are cached until a list is created or removed, or they're fetched with force
+            call_count = mock.call_count
+            self.assertEqual(self.callhub.get_dnc_lists(), expected_result)
+            self.assertEqual(mock.call_count, call_count)
+            mock.delete("https://api.callhub.io/v1/dnc_lists/5543/", status_code=204)
+            self.callhub.remove_dnc_list("5543")
+            self.assertEqual(self.callhub.get_dnc_lists(), expected_result)
+            self.assertEqual(mock.call_count, call_count + 2)
+            self.assertEqual(self.callhub.get_dnc_lists(force=True), expected_result)
+            self.assertEqual(mock.call_count, call_count + 3)
+
+    def test_dnc_list_created_after_caching(self):
+        default_list = {"url": "https://api.callhub.io/v1/dnc_lists/5543/", "name": "Default DNC List"}
+        new_list = {"url": "https://api.callhub.io/v1/dnc_lists/8794/", "name": "SMS Campaign 2020-01-1"}
+        with Mocker() as mock:
+            dnc_lists = mock.get('https://api.callhub.io/v1/dnc_lists/',
+                                 [{"json": {"count": 1, "next": None, "results": [default_list]}},
+                                  {"json": {"count": 2, "next": None, "results": [default_list, new_list]}}])
+            mock.post("https://api.callhub.io/v1/dnc_contacts/", status_code=201,
+                      json={"url": "https://api.callhub.io/v1/dnc_contacts/12345678/",
+                            "dnc": "https://api.callhub.io/v1/dnc_lists/8794/",
+                            "phone_number": "15555555555"})
+            self.assertEqual(self.callhub.get_dnc_lists(), {"5543": "Default DNC List"})
+
+            # The list was created elsewhere after the cache was filled, so the lists are fetched once more
+            results, errors = self.callhub.add_dnc(["15555555555"], "8794")
+            self.assertEqual(results, {"15555555555": [{"list_id": "8794", "name": "SMS Campaign 2020-01-1",
+                                                        "dnc_contact_id": "12345678"}]})
+            self.assertEqual(errors, [])
+            self.assertEqual(dnc_lists.call_count, 2)
+
+            # A list CallHub doesn't know about even after refreshing is still an error
+            with self.assertRaises(KeyError):
+                self.callhub.pretty_format_dnc_data([{"url": "https://api.callhub.io/v1/dnc_contacts/1/",
+                                                      "dnc": "https://api.callhub.io/v1/dnc_lists/1/",
+                                                      "phone_number": "15555555555"}])
+
     def test_get_dnc_phones(self):
         expected_result = {"16135554432": [
             {"list_id": "5543", "name": "Default DNC List", "dnc_contact_id": "9964"},
@@ -302,19 +747,43 @@ class TestInit(unittest.TestCase):
             # should get a requests_mock.exceptions.NoMockAddress when we try to remove any other dnc contact
             self.assertRaises(requests_mock.exceptions.NoMockAddress, self.callhub.remove_dnc, ["15555555555"])
 
+    def test_remove_dnc_looks_up_missing_numbers(self):
+        self.callhub.dnc_cache = {"1555000000{}".format(i): [] for i in range(10)}
+        self.callhub.get_dnc_phones = MagicMock(return_value={})
+        self.callhub.get_dnc_lists = MagicMock(return_value={"5543": "Default DNC List"})
+        dnc_contact = {"url": "https://api.callhub.io/v1/dnc_contacts/9964/",
+                       "dnc": "https://api.callhub.io/v1/dnc_lists/5543/",
+                       "phone_number": "15555555555"}
+        with Mocker() as mock:
+            mock.get("https://api.callhub.io/v1/dnc_contacts/?phone_number=15555555555",
+                     json={"count": 1, "next": None, "results": [dnc_contact]})
+            mock.delete("https://api.callhub.io/v1/dnc_contacts/9964/", status_code=204)
+            self.assertEqual(self.callhub.remove_dnc(["15555555555"]), [])
+            self.callhub.get_dnc_phones.assert_not_called()
+            self.assertEqual(self.callhub.dnc_cache["15555555555"][0]["dnc_contact_id"], "9964")
+
+            # If CallHub doesn't filter by phone number, the whole cache is refreshed instead
+            other_contact = dict(dnc_contact, phone_number="15554443333")
+            mock.get("https://api.callhub.io/v1/dnc_contacts/?phone_number=15551112222",
+                     json={"count": 1, "next": None, "results": [other_contact]})
+            self.callhub.get_dnc_phones.return_value = {"15551112222": []}
+            self.assertEqual(self.callhub.remove_dnc(["15551112222"]), [])
+            self.callhub.get_dnc_phones.assert_called_once_with()
+
     def test_remove_dnc_list(self):
         list_id = "9964"
+        url = DNC_LIST_URL.format(list_id)
         with Mocker() as mock:
-            mock.delete("https://api.callhub.io/v1/dnc_lists/{}/".format(list_id), status_code=204)
+            mock.delete(url, status_code=204)
             self.assertEqual(self.callhub.remove_dnc_list(list_id), None)
-            mock.delete("https://api.callhub.io/v1/dnc_lists/{}/".format(list_id), status_code=400)
+            mock.delete(url, status_code=400)
             self.assertRaises(RuntimeError, self.callhub.remove_dnc_list, list_id)
 
     def test_add_dnc_list(self):
         list_id = "9964"
         list_name = "This is a do not call list!"
         callhub_api_json = {
-            "url": "https://api.callhub.io/v1/dnc_lists/{}/".format(list_id),
+            "url": DNC_LIST_URL.format(list_id),
             "owner": "jamesbrunet",
             "name": list_name
         }
@@ -327,7 +796,7 @@ class TestInit(unittest.TestCase):
     def test_create_phonebook(self):
         phonebook_id = "123456789"
         callhub_api_json = {
-            "url": "https://api.callhub.io/v1/phonebooks/{}/".format(phonebook_id),
+            "url": PHONEBOOK_URL.format(phonebook_id),
             "owner": "doesnotmatter",
             "name": "my phonebook name",
             "description": "doesnotmatter"
@@ -395,10 +864,11 @@ class TestInit(unittest.TestCase):
 
     def test_remove_webhook(self):
         webhook_id = "1234"
+        url = WEBHOOK_URL.format(webhook_id)
         with Mocker() as mock:
-            mock.delete("https://api.callhub.io/v1/webhooks/{}/".format(webhook_id), status_code=204)
+            mock.delete(url, status_code=204)
             self.assertEqual(self.callhub.remove_webhook(webhook_id), None)
-            mock.delete("https://api.callhub.io/v1/webhooks/{}/".format(webhook_id), status_code=400)
+            mock.delete(url, status_code=400)
             self.assertRaises(RuntimeError, self.callhub.remove_webhook, webhook_id)
 
     def test_export_campaign(self):
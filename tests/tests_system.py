@@ -1,3 +1,4 @@
+import os
 import unittest
 from callhub import CallHub
 import random
@@ -5,6 +6,11 @@ import uuid
 
 '''NOTE: Mocking not set up here. Testing with this file makes LIVE CHANGES to your CallHub account!!!!'''
 
+# Only run against the real CallHub API when asked to
+LIVE = os.environ.get("CALLHUB_LIVE") == "1"
+
+
+@unittest.skipUnless(LIVE, "set CALLHUB_LIVE=1 to run tests against the live CallHub API")
 class TestInit(unittest.TestCase):
     @classmethod
     def setUpClass(cls):